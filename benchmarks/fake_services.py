@@ -0,0 +1,337 @@
+"""
+Local stand-ins for nyaa.si and the Telegram Bot API used by the benchmarks.
+Both run a threaded HTTP server on 127.0.0.1 and record timings of what they serve and receive.
+"""
+
+import hashlib
+import json
+import re
+import threading
+import time
+from email.parser import BytesParser
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, urlparse
+
+CATEGORIES = {
+    '1_2': 'Anime - English-translated',
+    '1_3': 'Anime - Non-English-translated',
+    '1_4': 'Anime - Raw',
+    '3_1': 'Literature - English-translated',
+}
+
+GROUPS = ['SubsPlease', 'Erai-raws', 'EMBER', 'ASW', 'Judas', 'Tsundere-Raws']
+
+
+def bencode(value):
+    if isinstance(value, int):
+        return b"i%de" % value
+    if isinstance(value, str):
+        value = value.encode()
+    if isinstance(value, bytes):
+        return b"%d:%s" % (len(value), value)
+    if isinstance(value, list):
+        return b"l" + b"".join(bencode(item) for item in value) + b"e"
+    return b"d" + b"".join(bencode(key) + bencode(value[key]) for key in sorted(value)) + b"e"
+
+
+def torrent_file(id, name):
+    return bencode({
+        'announce': 'http://nyaa.tracker.wf:7777/announce',
+        'info': {
+            'name': name,
+            'length': 1503238553,
+            'piece length': 1048576,
+            'pieces': hashlib.sha1(str(id).encode()).digest() * 64,
+        },
+    })
+
+
+class FakeServer:
+
+    def __init__(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, avoid delayed ACK stalls
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                server.handle(self, 'GET', b"")
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                server.handle(self, 'POST', body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reply(self, request, status, body=b"", headers=None):
+        request.send_response(status)
+        for name, value in (headers or {}).items():
+            request.send_header(name, value)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+
+class FakeNyaa(FakeServer):
+    """
+    Serves the newest `window` items as RSS, the /view/<id> pages and the
+    /download/<id>.torrent files of the published items.
+    """
+
+    def __init__(self, window=75, first_id=1800000):
+        super().__init__()
+        self.window = window
+        self.next_id = first_id
+        self.items = {}
+        self.lock = threading.Lock()
+        # First time each id was served, by the feed or by its view page
+        self.first_served = {}
+        self.requests = {'rss': 0, 'not_modified': 0, 'view': 0, 'download': 0}
+
+    def publish(self, count, category='1_2'):
+        with self.lock:
+            for _ in range(count):
+                id = self.next_id
+                self.next_id += 1
+                group = GROUPS[id % len(GROUPS)]
+                self.items[id] = {
+                    'id': id,
+                    'title': f"[{group}] Benchmark Show - {id % 1000:02d} (1080p) [{id:08X}].mkv",
+                    'category': category,
+                    'infohash': hashlib.sha1(str(id).encode()).hexdigest(),
+                    'published': time.time(),
+                }
+
+    def served(self, id):
+        self.first_served.setdefault(id, time.time())
+
+    def rss(self):
+        with self.lock:
+            items = [self.items[id] for id in sorted(self.items, reverse=True)[:self.window]]
+        xml_items = []
+        for item in items:
+            self.served(item['id'])
+            xml_items.append(
+                f"<item><title>{item['title']}</title>"
+                f"<link>{self.url}/download/{item['id']}.torrent</link>"
+                f"<guid isPermaLink=\"true\">{self.url}/view/{item['id']}</guid>"
+                f"<pubDate>{formatdate(item['published'])}</pubDate>"
+                f"<nyaa:seeders>0</nyaa:seeders><nyaa:leechers>0</nyaa:leechers><nyaa:downloads>0</nyaa:downloads>"
+                f"<nyaa:infoHash>{item['infohash']}</nyaa:infoHash>"
+                f"<nyaa:categoryId>{item['category']}</nyaa:categoryId>"
+                f"<nyaa:category>{CATEGORIES[item['category']]}</nyaa:category>"
+                f"<nyaa:size>1.4 GiB</nyaa:size><nyaa:comments>0</nyaa:comments>"
+                f"<nyaa:trusted>No</nyaa:trusted><nyaa:remake>No</nyaa:remake>"
+                f"<description><![CDATA[<a href=\"{self.url}/view/{item['id']}\">#{item['id']}</a>]]></description></item>"
+            )
+        return ('<?xml version="1.0" encoding="utf-8"?>'
+                '<rss xmlns:atom="http://www.w3.org/2005/Atom" xmlns:nyaa="https://nyaa.si/xmlns/nyaa" version="2.0">'
+                '<channel><title>Nyaa - Home - Torrent File RSS</title>'
+                + "".join(xml_items) + '</channel></rss>').encode()
+
+    def view_page(self, item):
+        self.served(item['id'])
+        category_name = CATEGORIES[item['category']].split(' - ')
+        main_category = item['category'].split('_')[0] + '_0'
+        return (f'<html><body><div class="panel-heading"><h3 class="panel-title">\n{item["title"]}\n</h3></div>'
+                f'<div class="row"><div class="col-md-1">Category:</div><div class="col-md-5">'
+                f'<a href="/?c={main_category}">{category_name[0]}</a> - <a href="/?c={item["category"]}">{category_name[1]}</a></div>'
+                f'<div class="col-md-1">Date:</div><div class="col-md-5" data-timestamp="{int(item["published"])}">x</div></div>'
+                f'<div class="row"><div class="col-md-1">File size:</div><div class="col-md-5">1.4 GiB</div></div>'
+                f'<div class="row"><div class="col-md-1">Info hash:</div><div class="col-md-5"><kbd>{item["infohash"]}</kbd></div></div>'
+                f'</body></html>').encode()
+
+    def torrent(self, item):
+        return torrent_file(item['id'], item['title'])
+
+    def handle(self, request, method, body):
+        path = urlparse(request.path).path
+        match = re.match(r'^/(view|download)/(\d+)', path)
+        if match:
+            with self.lock:
+                item = self.items.get(int(match.group(2)))
+            if item is None:
+                return self.reply(request, 404)
+            if match.group(1) == 'view':
+                self.requests['view'] += 1
+                return self.reply(request, 200, self.view_page(item), {'Content-Type': 'text/html'})
+            self.requests['download'] += 1
+            file_name = quote(f"{item['title']}.torrent")
+            return self.reply(request, 200, self.torrent(item), {
+                'Content-Type': 'application/x-bittorrent',
+                'Content-Disposition': f"inline; filename=\"{item['id']}.torrent\"; filename*=UTF-8''{file_name}",
+            })
+        content = self.rss()
+        etag = '"' + hashlib.sha1(content).hexdigest() + '"'
+        if request.headers.get('If-None-Match') == etag:
+            self.requests['not_modified'] += 1
+            return self.reply(request, 304, b"", {'ETag': etag})
+        self.requests['rss'] += 1
+        return self.reply(request, 200, content, {'Content-Type': 'application/xml', 'ETag': etag})
+
+
+class FakeTelegram(FakeServer):
+    """
+    Accepts the Bot API methods used by the bot and records every post with the nyaa id
+    found in its text or caption. latency simulates the API round trip in seconds.
+    """
+
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.message_id = 0
+        # (time, chat_id, method, nyaa id or None, uploaded bytes)
+        self.posts = []
+
+    def parse_body(self, request, body):
+        content_type = request.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            message = BytesParser().parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+            fields = {}
+            for part in message.get_payload():
+                name = part.get_param('name', header='content-disposition')
+                payload = part.get_payload(decode=True)
+                fields[name] = payload if part.get_filename() else payload.decode()
+            return fields
+        return json.loads(body or b"{}")
+
+    def post(self, chat_id, api_method, text, uploaded):
+        match = re.search(r'ID: (\d+)', text)
+        with self.lock:
+            now = time.time()
+            self.message_id += 1
+            self.posts.append((now, str(chat_id), api_method, int(match.group(1)) if match else None, uploaded))
+            return {
+                'message_id': self.message_id,
+                'date': int(now),
+                'chat': {'id': int(chat_id or 0), 'type': 'channel'},
+            }
+
+    def document(self, result):
+        result['document'] = {'file_id': f"FILE{result['message_id']}", 'file_unique_id': f"U{result['message_id']}"}
+        return result
+
+    def handle(self, request, method, body):
+        api_method = request.path.rsplit('/', 1)[-1]
+        fields = self.parse_body(request, body)
+        if self.latency:
+            time.sleep(self.latency)
+        if api_method == 'sendMediaGroup':
+            # One post per album item, attached files are referenced as attach://<field name>
+            media = fields['media'] if isinstance(fields['media'], list) else json.loads(fields['media'])
+            result = []
+            for item in media:
+                attached = fields.get(item['media'][len('attach://'):]) if item['media'].startswith('attach://') else None
+                uploaded = len(attached) if isinstance(attached, bytes) else 0
+                result.append(self.document(self.post(fields.get('chat_id'), api_method, item.get('caption') or '', uploaded)))
+            self.reply(request, 200, json.dumps({'ok': True, 'result': result}).encode(), {'Content-Type': 'application/json'})
+            return
+        text = fields.get('caption') or fields.get('text') or ''
+        uploaded = sum(len(value) for value in fields.values() if isinstance(value, bytes))
+        result = self.post(fields.get('chat_id'), api_method, text, uploaded)
+        if api_method == 'sendDocument':
+            self.document(result)
+        else:
+            result['text'] = text
+        self.reply(request, 200, json.dumps({'ok': True, 'result': result}).encode(), {'Content-Type': 'application/json'})
+
+
+class ReplayNyaa(FakeServer):
+    """
+    Serves the responses of a RECORD_FILE log in place of nyaa. The replay driver chooses the
+    feed response served for each feed URL, view pages and torrent files are served by path.
+    URLs of the recorded hosts in the bodies are rewritten to this server. A recorded 304 is
+    answered with the last recorded feed body when the request has no validators. Torrent files
+    missing from the log are generated and counted in `synthesized`.
+    """
+
+    def __init__(self, records):
+        super().__init__()
+        origins = set()
+        for record in records:
+            url = urlparse(record['url'])
+            origins.add(f"{url.scheme}://{url.netloc}".encode())
+        self.lock = threading.Lock()
+        # Feed records by feed path and query, other responses by path, last one wins
+        self.feeds = {}
+        self.responses = {}
+        for record in records:
+            body = record['body']
+            for origin in origins:
+                body = body.replace(origin, self.url.encode())
+            record = dict(record, body=body)
+            key = self.key(record['url'])
+            if 'page=rss' in key:
+                self.feeds.setdefault(key, []).append(record)
+            else:
+                self.responses[urlparse(record['url']).path] = record
+        self.current = {}
+        # Last feed response with a body served for each feed
+        self.full = {}
+        self.first_served = {}
+        self.synthesized = 0
+        self.requests = {'rss': 0, 'view': 0, 'download': 0}
+
+    @staticmethod
+    def key(url):
+        url = urlparse(url)
+        return url.path + ('?' + url.query if url.query else '')
+
+    def serve(self, record):
+        # Serve this feed record for its URL until the next one
+        with self.lock:
+            self.current[self.key(record['url'])] = record
+            if record['status'] == 200:
+                self.full[self.key(record['url'])] = record
+
+    def handle(self, request, method, body):
+        key = self.key(request.path)
+        if key in self.feeds:
+            with self.lock:
+                record = self.current.get(key)
+                if record is not None and record['status'] == 304 and key in self.full and \
+                        not request.headers.get('If-None-Match') and not request.headers.get('If-Modified-Since'):
+                    # The bot dropped its cached response, nyaa would send the whole feed
+                    record = self.full[key]
+                self.requests['rss'] += 1
+            if record is None:
+                return self.reply(request, 404)
+            now = time.time()
+            for id in re.findall(rb'/view/(\d+)', record['body']):
+                self.first_served.setdefault(int(id), now)
+            return self.reply(request, record['status'], record['body'], record['headers'])
+        path = urlparse(request.path).path
+        match = re.match(r'^/(view|download)/(\d+)', path)
+        if match:
+            self.requests[match.group(1)] += 1
+        record = self.responses.get(path)
+        if record is not None:
+            if match and match.group(1) == 'view' and record['status'] == 200:
+                self.first_served.setdefault(int(match.group(2)), time.time())
+            return self.reply(request, record['status'], record['body'], record['headers'])
+        if not match or match.group(1) != 'download':
+            return self.reply(request, 404)
+        with self.lock:
+            self.synthesized += 1
+        id = int(match.group(2))
+        return self.reply(request, 200, torrent_file(id, str(id)), {
+            'Content-Type': 'application/x-bittorrent',
+            'Content-Disposition': f"inline; filename=\"{id}.torrent\"; filename*=UTF-8''{id}.torrent",
+        })
@@ -0,0 +1,273 @@
+"""
+Replay a log recorded with RECORD_FILE through the bot pipeline, offline.
+
+A local server serves the recorded nyaa responses and the fake Telegram Bot API receives
+the posts. Each recorded feed response is fetched by fetch_rss_feed() at its recorded time,
+divided by --speed, while process_entries() sends the queued entries as in production.
+The items of the first feed response count as processed before the recording started,
+unless --include-first is given.
+
+Reports the settings used, throughput, p50/p99 latency from the first time an item is served
+to its first post, the stage timings of the bot and the posts out of order, duplicated or
+missing. Every id of the recording after the first feed response is expected to be posted.
+
+Usage:
+    python benchmarks/replay.py RECORD_FILE [--speed N] [--env NAME=VALUE ...] [--json]
+"""
+
+import argparse
+import importlib
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_PATH = os.path.dirname(BENCHMARKS_PATH)
+sys.path.insert(0, REPO_PATH)
+sys.path.insert(0, BENCHMARKS_PATH)
+
+from fake_services import FakeTelegram, ReplayNyaa
+from run_benchmark import percentile
+
+MAIN_CHANNEL = '-1000'
+
+# Settings printed with the results, they may differ from the recorded bot
+SETTINGS = ['BACKFILL_ENABLED', 'BACKFILL_WORKERS', 'BACKFILL_RATE', 'BACKFILL_MAX_ITEMS', 'DELAY_BETWEEN_SENDS',
+            'RATE_LIMIT_GLOBAL', 'QUEUE_MAX_SIZE', 'ALBUM_ENABLED']
+
+
+def configure(nyaa_url, telegram_url, work_path, feed_keys, environment):
+    os.environ.update({
+        'FEED_URL': nyaa_url + feed_keys[0],
+        'FEEDS': ",".join(nyaa_url + key.replace(',', '%2C') for key in feed_keys[1:]),
+        'TELEGRAM_BOT_TOKEN': '123456:REPLAY',
+        'TELEGRAM_API_URL': f"{telegram_url}/bot",
+        'TELEGRAM_CHANNEL_ID': MAIN_CHANNEL,
+        'ERROR_REPORT_USER_ID': '1',
+        'DOWNLOAD_PATH': os.path.join(work_path, 'downloads'),
+        'PROCESSED_DB_PATH': os.path.join(work_path, 'processed_ids.db'),
+        'QUEUE_JOURNAL': os.path.join(work_path, 'queue_journal.log'),
+        'FILE_ID_CACHE': os.path.join(work_path, 'file_ids.txt'),
+        'RECORD_FILE': '',
+        'LOG_LEVEL': 'warning',
+    })
+    os.environ.update(environment)
+
+
+def mark_first_processed(bot, feed_records):
+    # The bot had already processed the items of the feed window when the recording started
+    for records in feed_records.values():
+        entries, _ = bot.parse_feed_items(records[0]['body'])
+        for entry in entries:
+            bot.processed_store.add(bot.get_entry_id(entry), None, entry['nyaa_infohash'])
+    bot.processed_store.flush()
+    bot.max_processed_id = bot.processed_store.max_id()
+    for feed in bot.feeds:
+        feed.last_id = bot.max_processed_id
+
+
+def send_loop(bot, ready):
+    # The send thread of the runtime: process the entries each time the queue has new ones
+    while not bot.stop_event.is_set():
+        ready.wait(timeout=0.5)
+        ready.clear()
+        bot.process_entries()
+
+
+def recorded_ids(nyaa):
+    # Ids the recorded bot saw: in the feed responses, or with a view page or torrent file fetched
+    ids = set()
+    for records in nyaa.feeds.values():
+        for record in records:
+            ids.update(int(id) for id in re.findall(rb'/view/(\d+)', record['body']))
+    for path, record in nyaa.responses.items():
+        match = re.match(r'^/(view|download)/(\d+)', path)
+        if match and record['status'] == 200:
+            ids.add(int(match.group(2)))
+    return ids
+
+
+def drained(bot):
+    queued, _ = bot.entry_queue.backlog()
+    with bot.backfill_lock:
+        return queued == 0 and not bot.backfill_ids and not bot.failed_ids
+
+
+def stage_timings(bot):
+    timings = {}
+    for name, (buckets, total, count) in sorted(bot.histograms.items()):
+        if count:
+            timings[name] = {
+                'count': count,
+                'mean': round(total / count, 4),
+                'p50': bot.histogram_quantile(buckets, count, 0.5),
+                'p99': bot.histogram_quantile(buckets, count, 0.99),
+            }
+    return timings
+
+
+def anomalies(posts, expected_ids):
+    last_id = {}
+    out_of_order = []
+    seen = set()
+    duplicates = []
+    for _, chat_id, _, id, _ in posts:
+        if id is None:
+            continue
+        if id < last_id.get(chat_id, 0):
+            out_of_order.append((chat_id, id))
+        last_id[chat_id] = max(last_id.get(chat_id, 0), id)
+        if (chat_id, id) in seen:
+            duplicates.append((chat_id, id))
+        seen.add((chat_id, id))
+    missing = sorted(expected_ids - {id for _, id in seen})
+    return {
+        'out_of_order_posts': len(out_of_order),
+        'duplicate_posts': len(duplicates),
+        'missing_entries': len(missing),
+        'examples': {
+            'out_of_order': out_of_order[:10],
+            'duplicates': duplicates[:10],
+            'missing': missing[:10],
+        },
+    }
+
+
+def replay(path, speed, telegram_latency, include_first, drain_timeout, environment):
+    import nyaa_rss_bot
+
+    records = list(nyaa_rss_bot.read_recorded_responses(path))
+    nyaa = ReplayNyaa(records)
+    if not nyaa.feeds:
+        raise SystemExit(f"No feed response in {path}")
+    telegram = FakeTelegram(latency=telegram_latency)
+    nyaa_url = nyaa.start()
+    telegram_url = telegram.start()
+    work_path = tempfile.mkdtemp(prefix="nyaa_replay_")
+    os.chdir(work_path)
+    feed_keys = list(nyaa.feeds)
+    configure(nyaa_url, telegram_url, work_path, feed_keys, environment)
+    # Read the configuration again from the environment
+    bot = importlib.reload(nyaa_rss_bot)
+
+    bot.setup()
+    if not include_first:
+        mark_first_processed(bot, nyaa.feeds)
+    ready = threading.Event()
+    bot.entry_queue.listener = ready.set
+    sender = threading.Thread(target=send_loop, args=(bot, ready), daemon=True)
+    sender.start()
+    startup_posts = len(telegram.posts)
+
+    # Feed responses of all the feeds in recorded order, at the recorded pace divided by speed
+    feed_records = sorted(((record, feed_keys.index(key)) for key, key_records in nyaa.feeds.items() for record in key_records),
+                          key=lambda item: item[0]['time'])
+    first_time = feed_records[0][0]['time']
+    started = time.time()
+    for record, index in feed_records:
+        delay = started + (record['time'] - first_time) / speed - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        nyaa.serve(record)
+        bot.fetch_rss_feed(bot.feeds[index])
+    fetched = time.time()
+    deadline = fetched + drain_timeout
+    polled = fetched
+    while not drained(bot) and time.time() < deadline:
+        time.sleep(0.05)
+        # Poll the last responses again like the bot, to queue the ids dropped from a full queue
+        if bot.failed_ids and time.time() - polled >= 1:
+            polled = time.time()
+            for feed in bot.feeds:
+                bot.fetch_rss_feed(feed)
+    completed = drained(bot)
+    elapsed = time.time() - started
+    bot.stop_event.set()
+    ready.set()
+    sender.join(timeout=30)
+    bot.processed_store.close()
+
+    first_window = set()
+    if not include_first:
+        for key_records in nyaa.feeds.values():
+            entries, _ = bot.parse_feed_items(key_records[0]['body'])
+            first_window.update(int(bot.get_entry_id(entry)) for entry in entries)
+    # Every recorded id should be posted, even if the replayed bot never requested it
+    expected_ids = recorded_ids(nyaa) - first_window
+    posts = [post for post in telegram.posts[startup_posts:] if post[1] != os.environ['ERROR_REPORT_USER_ID']]
+    first_post = {}
+    for posted_at, _, _, id, _ in posts:
+        if id is not None:
+            first_post.setdefault(id, posted_at)
+    latencies = [first_post[id] - nyaa.first_served[id] for id in first_post if id in nyaa.first_served]
+    # The first message to the admin is the start message, sent in the background
+    errors = [post for post in telegram.posts if post[1] == os.environ['ERROR_REPORT_USER_ID']][1:]
+    return {
+        'records': len(records),
+        'feed_responses': len(feed_records),
+        'recorded_seconds': round(feed_records[-1][0]['time'] - first_time, 2),
+        'speed': speed,
+        'settings': {name: getattr(bot, name) for name in SETTINGS},
+        'completed': completed,
+        'seconds': round(elapsed, 2),
+        'drain_seconds': round(time.time() - fetched, 2),
+        'entries': len(first_post),
+        'posts': len(posts),
+        'entries_per_second': round(len(first_post) / elapsed, 2) if elapsed else 0,
+        'posts_per_second': round(len(posts) / elapsed, 2) if elapsed else 0,
+        'latency_p50': round(percentile(latencies, 50), 3),
+        'latency_p99': round(percentile(latencies, 99), 3),
+        'stages': stage_timings(bot),
+        'anomalies': anomalies(posts, expected_ids),
+        'error_reports': len(errors),
+        'nyaa_requests': nyaa.requests,
+        'synthesized_torrents': nyaa.synthesized,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a RECORD_FILE log through the bot pipeline.")
+    parser.add_argument('record_file', help="log recorded with RECORD_FILE")
+    parser.add_argument('--speed', type=float, default=1, help="replay speed, 10 replays 10 minutes in 1 (default 1)")
+    parser.add_argument('--telegram-latency', type=float, default=0.02, help="simulated Bot API round trip in seconds")
+    parser.add_argument('--include-first', action='store_true', help="also send the items of the first feed response")
+    parser.add_argument('--drain-timeout', type=float, default=600, help="seconds to wait for the queue to drain after the last fetch")
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help="bot setting, like --env ALBUM_ENABLED=1")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+    environment = {}
+    for setting in args.env:
+        name, separator, value = setting.partition('=')
+        if not separator:
+            parser.error(f"invalid setting {setting}, expected NAME=VALUE")
+        environment[name] = value
+
+    result = replay(os.path.abspath(args.record_file), args.speed, args.telegram_latency, args.include_first,
+                    args.drain_timeout, environment)
+    if args.json:
+        print(json.dumps(result))
+        return
+    print(f"replayed {result['feed_responses']} feed responses ({result['records']} records, {result['recorded_seconds']} s recorded) "
+          f"at {result['speed']}x in {result['seconds']} s, drained {result['drain_seconds']} s after the last fetch"
+          + ("" if result['completed'] else " (not drained)"))
+    print("settings: " + ", ".join(f"{name}={value}" for name, value in result['settings'].items()))
+    print(f"entries: {result['entries']} ({result['entries_per_second']}/s), posts: {result['posts']} ({result['posts_per_second']}/s), "
+          f"latency p50 {result['latency_p50']} s, p99 {result['latency_p99']} s")
+    print(f"{'stage':<45} {'count':>6} {'mean s':>8} {'p50 s':>7} {'p99 s':>7}")
+    for name, timing in result['stages'].items():
+        print(f"{name:<45} {timing['count']:>6} {timing['mean']:>8} {timing['p50']:>7} {timing['p99']:>7}")
+    found = result['anomalies']
+    print(f"out of order posts: {found['out_of_order_posts']}, duplicate posts: {found['duplicate_posts']}, "
+          f"missing entries: {found['missing_entries']}, error reports: {result['error_reports']}, "
+          f"torrents not recorded: {result['synthesized_torrents']}")
+    for kind, examples in found['examples'].items():
+        if examples:
+            print(f"  {kind}: {examples}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+Micro-benchmark of the routing rules engine against a linear scan of the same rules.
+
+Generates release group x series x resolution rules plus regex, size and trusted rules,
+checks that both give the same channels for every title and reports the cost per entry.
+Also checks regex rules with groups and inline flags, which can't share the combined regex.
+
+Usage:
+    python benchmarks/rules_benchmark.py [--rules N] [--entries N]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+import nyaa_rss_bot
+
+GROUPS = ["SubsPlease", "Erai-raws", "EMBER", "ASW", "Judas", "Tsundere-Raws", "DKB", "Yameii", "ToonsHub", "Anime Time",
+          "VARYG", "LostYears", "Kanjouteki", "Cleo", "SanKyuu", "Chihiro", "Commie", "Okay-Subs", "GJM", "Vodes"]
+RESOLUTIONS = ["1080p", "720p", "480p", "2160p"]
+CATEGORIES = ["1_2", "1_3", "1_4", "2_2", "3_1", "4_2", "6_1"]
+
+
+def series_names(count):
+    random.seed(1)
+    syllables = ["ka", "na", "shi", "to", "ri", "me", "yu", "ko", "sa", "ra", "mi", "no", "ta", "ne", "ho"]
+    names = set()
+    while len(names) < count:
+        names.add(" ".join("".join(random.choice(syllables) for _ in range(random.randint(2, 4))).capitalize()
+                           for _ in range(random.randint(1, 3))))
+    return sorted(names)
+
+
+def generate_rules(count):
+    series = series_names(count // 10 + 10)
+    rules = []
+    index = 0
+    while len(rules) < count:
+        kind = index % 20
+        name = series[index % len(series)]
+        group = GROUPS[index % len(GROUPS)]
+        channel = f"-100{index % 300:04d}"
+        if kind == 0:
+            rules.append({'channel': channel, 'regex': rf"{name.split()[0]}.* - \d+ \(1080p\)"})
+        elif kind == 1:
+            rules.append({'channel': channel, 'category': CATEGORIES[index % len(CATEGORIES)], 'trusted': True, 'min_size': "1 GiB"})
+        else:
+            rules.append({'channel': channel, 'title': [group, name, RESOLUTIONS[index % len(RESOLUTIONS)]],
+                          'exclude': "batch", 'category': "1_0"})
+        index += 1
+    return rules, series
+
+
+def generate_entries(count, series):
+    random.seed(2)
+    entries = []
+    for id in range(count):
+        batch = " (Batch)" if random.random() < 0.05 else ""
+        entries.append({
+            'title': f"[{random.choice(GROUPS)}] {random.choice(series)} - {random.randint(1, 24):02d} ({random.choice(RESOLUTIONS)}){batch} [{id:08X}].mkv",
+            'nyaa_categoryid': random.choice(CATEGORIES),
+            'nyaa_size': f"{random.uniform(0.1, 4):.1f} GiB",
+            'nyaa_trusted': random.choice(["Yes", "No"]),
+            'nyaa_remake': "No",
+        })
+    return entries
+
+
+def linear_match(rules, entry):
+    # Reference: evaluate every rule
+    found_all = nyaa_rss_bot.TitleMatcher([])
+    channels = []
+    title = entry['title'].lower()
+    for rule in rules:
+        if rule.channel in channels:
+            continue
+        if not all(literal in title for literal in rule.titles) or any(literal in title for literal in rule.excludes):
+            continue
+        if rule.matches(entry, set(rule.title_ids)):
+            channels.append(rule.channel)
+    return channels
+
+
+# Regex rules that can't be combined in one regex: (rules, title) pairs
+REGEX_CASES = [
+    ([r"(?i)foo", r"bar"], "BAR 01"),
+    ([r"(?P<g>x)", r"(?P<g>y)"], "y 01"),
+    ([r"(x)\1", r"(y)\1"], "yy zz"),
+    ([r"(?s)a.b", r"(?:c)d", r"e"], "e 02"),
+]
+
+
+def check_regex_cases():
+    # Mismatches between the engine and a linear scan on the regex cases
+    mismatches = 0
+    for patterns, title in REGEX_CASES:
+        engine = nyaa_rss_bot.RuleEngine([nyaa_rss_bot.RoutingRule(channel=f"-100{index}", regex=pattern)
+                                          for index, pattern in enumerate(patterns)])
+        entry = {'title': title, 'nyaa_categoryid': "1_2"}
+        if engine.match(entry) != linear_match(engine.rules, entry):
+            mismatches += 1
+    return mismatches
+
+
+def measure(function, entries):
+    started = time.perf_counter()
+    results = [function(entry) for entry in entries]
+    return (time.perf_counter() - started) / len(entries) * 1e6, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the routing rules engine.")
+    parser.add_argument('--rules', type=int, default=1200, help="number of rules (default 1200)")
+    parser.add_argument('--entries', type=int, default=5000, help="number of entries to route (default 5000)")
+    args = parser.parse_args()
+
+    rule_specs, series = generate_rules(args.rules)
+    started = time.perf_counter()
+    engine = nyaa_rss_bot.RuleEngine([nyaa_rss_bot.RoutingRule(**rule) for rule in rule_specs])
+    compile_ms = (time.perf_counter() - started) * 1000
+    entries = generate_entries(args.entries, series)
+
+    engine_us, engine_results = measure(engine.match, entries)
+    linear_us, linear_results = measure(lambda entry: linear_match(engine.rules, entry), entries)
+    mismatches = sum(1 for a, b in zip(engine_results, linear_results) if a != b)
+    matched = sum(1 for result in engine_results if result)
+
+    print(f"rules: {len(engine.rules)}, title patterns: {engine.literals}, compiled in {compile_ms:.1f} ms")
+    print(f"entries: {len(entries)}, routed to at least one channel: {matched}, mismatches: {mismatches}")
+    print(f"engine: {engine_us:.1f} us/entry")
+    print(f"linear scan: {linear_us:.1f} us/entry ({linear_us / engine_us:.1f}x)")
+    print(f"regex cases: {len(REGEX_CASES)}, mismatches: {check_regex_cases()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""
+Offline benchmark of the bot pipeline against local fake nyaa and Telegram servers.
+
+Each scenario runs in its own process with a fresh working folder and reports
+entries per second, p50/p99 latency from the first time an item is served to
+its first post, and memory usage.
+
+Usage:
+    python benchmarks/run_benchmark.py [scenario ...] [--telegram-latency SECONDS] [--record FILE]
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_PATH = os.path.dirname(BENCHMARKS_PATH)
+
+# name: (description, fan-out channels, warmup items, publish steps as (delay, count), extra environment)
+SCENARIOS = {
+    'trickle': ("steady trickle, 2 items/s for 20 s", 1, 5, [(1, 2)] * 20, {}),
+    'burst': ("500-item burst, beyond the 75-item feed window", 1, 5, [(0, 500)], {}),
+    'fanout': ("50 items sent to 10 channels", 10, 5, [(0, 50)], {}),
+    'album': ("50 items sent to 10 channels as albums", 10, 5, [(0, 50)], {'ALBUM_ENABLED': '1'}),
+    'sharded': ("50 items sent to 10 channels by 4 bots", 10, 5, [(0, 50)],
+                {'SHARD_BOT_TOKENS': ",".join(f"{100000 + bot}:BENCHMARK" for bot in range(1, 5)), 'LOG_LEVEL': 'warning'}),
+}
+
+SCENARIO_TIMEOUT = 600
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def configure(nyaa_url, telegram_url, work_path, channels):
+    os.environ.update({
+        'FEED_URL': f"{nyaa_url}/?page=rss",
+        'CHECK_INTERVAL': '1',
+        'POLL_INTERVAL_MIN': '1',
+        'RETRY_COUNT': '3',
+        'TELEGRAM_BOT_TOKEN': '123456:BENCHMARK',
+        'TELEGRAM_API_URL': f"{telegram_url}/bot",
+        'TELEGRAM_CHANNEL_ID': '-1000',
+        'ERROR_REPORT_USER_ID': '1',
+        'DOWNLOAD_PATH': os.path.join(work_path, 'downloads'),
+        'CATEGORY_CHANNEL_MAPPINGS': ",".join(f"1_2|-{1000 + channel}|1" for channel in range(1, channels)),
+        'DELAY_BETWEEN_SENDS': '0',
+        'RATE_LIMIT_GLOBAL': '0',
+        'PROCESSED_DB_PATH': os.path.join(work_path, 'processed_ids.db'),
+        'QUEUE_JOURNAL': os.path.join(work_path, 'queue_journal.log'),
+        'FILE_ID_CACHE': os.path.join(work_path, 'file_ids.txt'),
+        'BACKFILL_ENABLED': '1',
+        'BACKFILL_RATE': '100',
+        'BACKFILL_WORKERS': '4',
+        'BACKFILL_MAX_ITEMS': '1000',
+    })
+
+
+def wait_posted(telegram, ids, channels, deadline):
+    # Wait until every id has been posted to every channel
+    while time.time() < deadline:
+        with telegram.lock:
+            posted = {(chat_id, id) for _, chat_id, _, id, _ in telegram.posts if id in ids}
+        if len(posted) >= len(ids) * channels:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def run_scenario(name, telegram_latency, record=None):
+    sys.path.insert(0, REPO_PATH)
+    sys.path.insert(0, BENCHMARKS_PATH)
+    from fake_services import FakeNyaa, FakeTelegram
+
+    description, channels, warmup, steps, environment = SCENARIOS[name]
+    nyaa = FakeNyaa()
+    telegram = FakeTelegram(latency=telegram_latency)
+    nyaa_url = nyaa.start()
+    telegram_url = telegram.start()
+    work_path = tempfile.mkdtemp(prefix=f"nyaa_bench_{name}_")
+    os.chdir(work_path)
+    configure(nyaa_url, telegram_url, work_path, channels)
+    os.environ.update(environment)
+    if record:
+        os.environ['RECORD_FILE'] = record
+
+    tracemalloc.start()
+    import nyaa_rss_bot
+    nyaa_rss_bot.log = lambda *args, **kwargs: None
+
+    # Warmup: process a few items so the bot has a last processed id
+    nyaa.publish(warmup)
+    nyaa_rss_bot.setup()
+    runner = threading.Thread(target=nyaa_rss_bot.run, daemon=True)
+    runner.start()
+    deadline = time.time() + SCENARIO_TIMEOUT
+    wait_posted(telegram, set(nyaa.items), channels, deadline)
+    warmup_posts = len(telegram.posts)
+    tracemalloc.reset_peak()
+
+    first_id = nyaa.next_id
+    started = time.time()
+    for delay, count in steps:
+        nyaa.publish(count)
+        time.sleep(delay)
+    ids = set(range(first_id, nyaa.next_id))
+    completed = wait_posted(telegram, ids, channels, deadline)
+    elapsed = time.time() - started
+    _, peak_memory = tracemalloc.get_traced_memory()
+
+    nyaa_rss_bot.stop_event.set()
+    runner.join(timeout=10)
+
+    posts = [post for post in telegram.posts[warmup_posts:] if post[3] in ids]
+    first_post = {}
+    for posted_at, _, _, id, _ in posts:
+        first_post.setdefault(id, posted_at)
+    latencies = [first_post[id] - nyaa.first_served[id] for id in first_post if id in nyaa.first_served]
+    out_of_order = sum(1 for previous, current in zip(posts, posts[1:]) if current[3] < previous[3] and current[1] == previous[1])
+    return {
+        'scenario': name,
+        'description': description,
+        'completed': completed,
+        'entries': len(first_post),
+        'posts': len(posts),
+        'seconds': round(elapsed, 2),
+        'entries_per_second': round(len(first_post) / elapsed, 2) if elapsed else 0,
+        'latency_p50': round(percentile(latencies, 50), 3),
+        'latency_p99': round(percentile(latencies, 99), 3),
+        'uploaded_bytes': sum(post[4] for post in posts),
+        'out_of_order_posts': out_of_order,
+        'peak_traced_memory_mb': round(peak_memory / 1048576, 2),
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2),
+        'nyaa_requests': nyaa.requests,
+        'startup_seconds': nyaa_rss_bot.metrics.get('startup_seconds'),
+        'time_to_first_post': nyaa_rss_bot.metrics.get('time_to_first_post_seconds'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bot pipeline against local fake services.")
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS), help="one or more of: " + ", ".join(SCENARIOS))
+    parser.add_argument('--telegram-latency', type=float, default=0.02, help="simulated Bot API round trip in seconds")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON lines")
+    parser.add_argument('--record', help="record the nyaa responses to this file, to replay them with replay.py (one scenario only)")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name}")
+    if args.record and not args.child and len(args.scenarios) > 1:
+        parser.error("--record needs a single scenario")
+
+    if args.child:
+        print(json.dumps(run_scenario(args.child, args.telegram_latency, args.record)))
+        return
+
+    results = []
+    for name in args.scenarios:
+        command = [sys.executable, os.path.abspath(__file__), '--child', name, '--telegram-latency', str(args.telegram_latency)]
+        if args.record:
+            command += ['--record', os.path.abspath(args.record)]
+        output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        if args.json:
+            print(json.dumps(result))
+
+    if not args.json:
+        print(f"{'scenario':<10} {'done':<5} {'entries':>7} {'posts':>6} {'seconds':>8} {'entries/s':>9} "
+              f"{'p50 s':>7} {'p99 s':>7} {'peak MB':>8} {'rss MB':>7}")
+        for result in results:
+            print(f"{result['scenario']:<10} {str(result['completed']):<5} {result['entries']:>7} {result['posts']:>6} "
+                  f"{result['seconds']:>8} {result['entries_per_second']:>9} {result['latency_p50']:>7} "
+                  f"{result['latency_p99']:>7} {result['peak_traced_memory_mb']:>8} {result['max_rss_mb']:>7}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
-version="1.4.1"
-released="2024 jun 02"
+version="1.5"
+released="2026 oct 17"
 
 #changelog
 # V1.0 - 13/07/2023
@@ -50,20 +50,111 @@ released="2024 jun 02"
 #
 # V1.4.1 - 2024/06/02
 #   added safe threshold to avoid false positives on alert for new items
+#
+# V1.5 - 2026/10/17
+#   replaced the global rss_entries list with a deduplicating, bounded work queue ordered by id
+#   added QUEUE_MAX_SIZE environment variable to limit the number of queued entries
+#   entries beyond QUEUE_MAX_SIZE wait in an overflow instead of being dropped
+#   the processing thread now waits on the queue instead of polling every second
+#   feed requests use ETag/Last-Modified conditional GET and skip unchanged payloads by hash
+#   feed items are stream-parsed with iterparse and parsing stops at the first already processed id
+#   feed and torrent downloads share a pooled keep-alive HTTP session with retries and backoff
+#   added HTTP_POOL_SIZE, HTTP_RETRY_COUNT and HTTP_RETRY_BACKOFF environment variables
+#   added counters for HTTP requests and reused connections
+#   torrent files are downloaded ahead of the sender by a pool of prefetch threads
+#   added PREFETCH_WORKERS and PREFETCH_DEPTH environment variables
+#   replaced the fixed sleep after each send with per-chat and global token buckets
+#   DELAY_BETWEEN_SENDS is now the minimum delay between sends to the same chat
+#   added RATE_LIMIT_GLOBAL environment variable to limit the sends per second across all chats
+#   RetryAfter errors pause and slow down only the chat that received them
+#   torrent files are uploaded once, the Telegram file_id is reused for the other destinations
+#   added FILE_ID_CACHE environment variable to persist the uploaded file_ids by id and infohash
+#   BadRequest errors are not retried when sending
+#   processed ids are saved in a SQLite database (WAL mode) indexed by id and infohash
+#   the database records file name, infohash, delivery status per destination and timestamps
+#   processed_ids.txt is migrated to the database on first start and kept as fallback backend
+#   added PROCESSED_STORE, PROCESSED_DB_PATH and PROCESSED_STORE_BATCH_SIZE environment variables
+#   queued entries and deliveries are journaled to disk, pending entries are resumed on restart
+#   destinations already delivered are skipped when an entry is processed again
+#   added QUEUE_JOURNAL and QUEUE_JOURNAL_COMPACT_SIZE environment variables
+#   detect ids missing between the last processed id and the oldest item of the feed window
+#   missing ids are backfilled concurrently from the /view and /download pages, rate limited
+#   added BACKFILL_ENABLED, BACKFILL_WORKERS, BACKFILL_RATE and BACKFILL_MAX_ITEMS environment variables
+#   added backlog size metric
+#   the script can be imported: startup moved to setup(), run() and main()
+#   added TELEGRAM_API_URL environment variable to use a local Bot API server
+#   added benchmark suite with local fake nyaa and Telegram servers
+#   added FEEDS environment variable to poll more feeds, each with its own interval and channels
+#   feeds are polled concurrently and share the processed ids, the queue and the send pipeline
+#   an item found in several feeds is downloaded and uploaded once and sent to all their channels
+#   adaptive polling: the interval follows the arrival rate of new items, within POLL_INTERVAL_MIN and POLL_INTERVAL_MAX
+#   polls faster when a fetch returns an almost full window of new items, backs off on errors and honors Retry-After
+#   added POLL_ADAPTIVE, POLL_INTERVAL_MIN, POLL_INTERVAL_MAX, POLL_TARGET_ITEMS, POLL_RATE_WINDOW and POLL_FULL_WINDOW_RATIO environment variables
+#   removed the schedule dependency
+#   optional album mode: torrents of a burst going to the same channel are sent as albums of up to 10 documents
+#   added ALBUM_ENABLED, ALBUM_WINDOW and ALBUM_MAX_SIZE environment variables
+#   timing histograms of feed fetch, parse, torrent download, disk write and Telegram sends
+#   counters of retries, RetryAfter hits, dedup skips and bytes, queue depth gauge
+#   metrics served in the Prometheus text format on METRICS_PORT and summarized in the log every METRICS_SUMMARY_INTERVAL seconds
+#   leveled log with LOG_LEVEL: step by step logs moved to debug and formatted only when enabled
+#   asyncio runtime: feeds, queue processing and periodic checks are tasks, blocking work runs in thread pools
+#   the processing thread wakes up only when the queue has new entries, no more idle polling
+#   graceful shutdown on SIGINT and SIGTERM, the current poll and entry are completed first
+#   added routing rules file (ROUTING_RULES_FILE): send entries to channels by title literals, regex, category, trusted, remake and size
+#   all title literals are matched at once with an Aho-Corasick automaton, rules are indexed by literal and category
+#   trusted and remake flags are parsed from the feed
+#   torrent files are stored once: indexed in memory by id and infohash, shard folders listed once instead of probing each file
+#   the download is skipped when the torrent is already stored, files are written atomically, no more _1 duplicates
+#   torrent files are streamed to disk in chunks and checked as bencoded torrents before being renamed in place, invalid ones are sent as message only
+#   added TORRENT_MAX_SIZE environment variable: larger torrents are sent as message only
+#   a torrent file is read once for all its destinations and send retries
+#   replaced the alert check refetching the feed with a lag monitor fed by the poller, no more extra HTTP requests
+#   processing lag in items and seconds and time since the last poll of each feed exposed as metrics
+#   lag alerts with hysteresis: repeated when the lag doubles, cleared when it falls below half the threshold
+#   added LAG_CHECK_INTERVAL, LAG_ALERT_SECONDS and LAG_ALERT_ITEMS environment variables
+#   optional sharding (SHARD_BOT_TOKENS): destinations are split across bot tokens, each sending from its own worker process
+#   fetch, download and dedup run once in the main process, which feeds the shards through multiprocessing queues
+#   each shard has its own rate limiter and file_id cache, deliveries are recorded by the main process and dead shards are restarted
+#   added RECORD_FILE environment variable: the feed, view and torrent responses are recorded to a compact log with their time
+#   added replay driver to run a recorded log through the pipeline offline, at 1x or accelerated speed
+#   faster startup: the start message is sent in the background and the first feed fetch starts right after setup
+#   processed ids text file, file_id cache and queue journal are loaded in the background, the first fetch waits for them only before parsing
+#   startup time, time to first fetch and time to first post reported in the log and as metrics
 
 
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import traceback
-from telegram import Bot, InputFile
-from telegram.error import RetryAfter
+from telegram import Bot, InputFile, InputMediaDocument
+from telegram.utils.request import Request
+from telegram.error import RetryAfter, BadRequest
 from urllib.parse import urlparse, quote, unquote
 from dotenv import load_dotenv
 import re
 import threading
+import heapq
+import collections
+import contextlib
+import bisect
+import mmap
+import asyncio
+import signal
+import multiprocessing
+import queue
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
+import struct
+import sqlite3
+import json
+import html
+from email.utils import formatdate, parsedate_to_datetime
 import xml.etree.ElementTree as ET
-import schedule
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
 class CategoryChannel:
     def __init__(self, category, channel, enabled):
@@ -71,98 +162,993 @@ class CategoryChannel:
         self.channel = channel
         self.enabled = enabled
 
+class Feed:
+    """
+    A polled RSS feed. Entries of a feed without destinations go to the global channel
+    and to the category channels, the others only to the feed destinations.
+    """
+
+    def __init__(self, url, interval, destinations=None, backfill=False, name='main'):
+        self.url = url
+        self.interval = interval
+        self.name = name
+        self.destinations = destinations
+        self.backfill = backfill
+        # Validators of the last response used for conditional requests
+        self.etag = None
+        self.last_modified = None
+        self.hash = None
+        # Highest id queued from this feed, parsing stops there
+        self.last_id = 0
+        # Oldest id of the whole feed window, when the last parse reached it
+        self.oldest_id = 0
+        # Publish times of the recent items, to estimate the arrival rate
+        self.arrivals = collections.deque()
+        # Number of items in a whole feed page, learned when no item was already seen
+        self.window_size = 75
+        self.errors = 0
+        # Newest id seen in the feed and time of the last successful poll (or of the start), for the lag monitor
+        self.newest_id = 0
+        self.polled_at = time.time()
+
+    def arrival_rate(self):
+        # Items per second over the last POLL_RATE_WINDOW seconds
+        now = time.time()
+        while self.arrivals and self.arrivals[0][0] < now - POLL_RATE_WINDOW:
+            self.arrivals.popleft()
+        if not self.arrivals:
+            return 0
+        span = max(now - self.arrivals[0][0], POLL_INTERVAL_MIN)
+        return sum(count for _, count in self.arrivals) / span
+
+    def on_poll_success(self, entries=(), window_full=False, missed=0):
+        # Track the new items, then poll faster when items arrive faster, slower when idle
+        self.errors = 0
+        self.polled_at = time.time()
+        if entries:
+            self.newest_id = max([self.newest_id] + [int(get_entry_id(entry)) for entry in entries])
+            published = []
+            for entry in entries:
+                try:
+                    published.append(parsedate_to_datetime(entry['published']).timestamp())
+                except Exception:
+                    published.append(time.time())
+            # Kept in time order, arrival_rate() prunes the oldest ones first
+            for timestamp in published:
+                bisect.insort(self.arrivals, (timestamp, 1))
+            if missed:
+                # Items that scrolled out of the window, counted from the ids
+                bisect.insort(self.arrivals, (min(published), missed))
+        if not POLL_ADAPTIVE:
+            return
+        if window_full:
+            # The window was (almost) all new: items may be lost if we don't hurry
+            self.set_interval(POLL_INTERVAL_MIN)
+            return
+        rate = self.arrival_rate()
+        interval = POLL_TARGET_ITEMS / rate if rate else POLL_INTERVAL_MAX
+        # Change at most by a factor 2 per poll so a single quiet or busy poll doesn't swing it
+        self.set_interval(min(max(interval, self.interval / 2), self.interval * 2))
+
+    def on_poll_error(self, retry_after=None):
+        # Exponential backoff, honoring the Retry-After of the server
+        self.errors += 1
+        if not POLL_ADAPTIVE:
+            return
+        self.set_interval(self.interval * 2)
+        if retry_after:
+            self.interval = max(self.interval, retry_after)
+
+    def set_interval(self, interval):
+        self.interval = round(min(max(interval, POLL_INTERVAL_MIN), POLL_INTERVAL_MAX), 1)
+
+    def route(self, entry):
+        if self.destinations is None:
+            return get_default_destinations(entry)
+        return list(self.destinations)
+
+    def reset_cache(self):
+        # Force the next fetch to download and parse the whole feed again
+        self.etag = None
+        self.last_modified = None
+        self.hash = None
+
 # Load environment variables
 load_dotenv()
 FEED_URL = os.getenv('FEED_URL')
-CHECK_INTERVAL = int(os.getenv('CHECK_INTERVAL'))
-RETRY_COUNT = int(os.getenv('RETRY_COUNT'))
+CHECK_INTERVAL = int(os.getenv('CHECK_INTERVAL') or 30)
+RETRY_COUNT = int(os.getenv('RETRY_COUNT') or 10)
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL') or None
 TELEGRAM_CHANNEL_ID = os.getenv('TELEGRAM_CHANNEL_ID')
-DOWNLOAD_PATH = os.getenv('DOWNLOAD_PATH')
+DOWNLOAD_PATH = os.getenv('DOWNLOAD_PATH') or 'downloads/'
 ERROR_REPORT_USER_ID = os.getenv('ERROR_REPORT_USER_ID')
 FEED_REQUEST_TIMEOUT = int(os.getenv('FEED_REQUEST_TIMEOUT') or 30)
 TORRENT_FILE_REQUEST_TIMEOUT = int(os.getenv('TORRENT_FILE_REQUEST_TIMEOUT') or 30)
+TORRENT_MAX_SIZE = int(os.getenv('TORRENT_MAX_SIZE') or 20 * 1024 * 1024)
 DELAY_BETWEEN_SENDS = int(os.getenv('DELAY_BETWEEN_SENDS') or 3)
+QUEUE_MAX_SIZE = int(os.getenv('QUEUE_MAX_SIZE') or 1000)
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE') or 10)
+HTTP_RETRY_COUNT = int(os.getenv('HTTP_RETRY_COUNT') or 3)
+HTTP_RETRY_BACKOFF = float(os.getenv('HTTP_RETRY_BACKOFF') or 1)
+PREFETCH_WORKERS = int(os.getenv('PREFETCH_WORKERS') or 4)
+PREFETCH_DEPTH = int(os.getenv('PREFETCH_DEPTH') or 8)
+RATE_LIMIT_GLOBAL = float(os.getenv('RATE_LIMIT_GLOBAL') or 30)
+FILE_ID_CACHE = os.getenv('FILE_ID_CACHE') or ''
+PROCESSED_STORE = os.getenv('PROCESSED_STORE') or 'sqlite'
+PROCESSED_DB_PATH = os.getenv('PROCESSED_DB_PATH') or 'processed_ids.db'
+PROCESSED_STORE_BATCH_SIZE = int(os.getenv('PROCESSED_STORE_BATCH_SIZE') or 20)
+QUEUE_JOURNAL = os.getenv('QUEUE_JOURNAL', 'queue_journal.log')
+QUEUE_JOURNAL_COMPACT_SIZE = int(os.getenv('QUEUE_JOURNAL_COMPACT_SIZE') or 1000)
+BACKFILL_ENABLED = os.getenv('BACKFILL_ENABLED') == '1'
+BACKFILL_WORKERS = int(os.getenv('BACKFILL_WORKERS') or 2)
+BACKFILL_RATE = float(os.getenv('BACKFILL_RATE') or 1)
+BACKFILL_MAX_ITEMS = int(os.getenv('BACKFILL_MAX_ITEMS') or 300)
+FEEDS = os.getenv('FEEDS') or ''
+POLL_ADAPTIVE = os.getenv('POLL_ADAPTIVE') != '0'
+POLL_INTERVAL_MIN = float(os.getenv('POLL_INTERVAL_MIN') or 10)
+POLL_INTERVAL_MAX = float(os.getenv('POLL_INTERVAL_MAX') or 300)
+POLL_TARGET_ITEMS = float(os.getenv('POLL_TARGET_ITEMS') or 3)
+POLL_RATE_WINDOW = int(os.getenv('POLL_RATE_WINDOW') or 3600)
+POLL_FULL_WINDOW_RATIO = float(os.getenv('POLL_FULL_WINDOW_RATIO') or 0.8)
+ALBUM_ENABLED = os.getenv('ALBUM_ENABLED') == '1'
+ALBUM_WINDOW = float(os.getenv('ALBUM_WINDOW') or 2)
+ALBUM_MAX_SIZE = min(int(os.getenv('ALBUM_MAX_SIZE') or 10), 10)  # Telegram albums hold up to 10 documents
+ROUTING_RULES_FILE = os.getenv('ROUTING_RULES_FILE') or ''
+METRICS_PORT = int(os.getenv('METRICS_PORT') or 0)
+METRICS_HOST = os.getenv('METRICS_HOST') or '127.0.0.1'
+METRICS_SUMMARY_INTERVAL = int(os.getenv('METRICS_SUMMARY_INTERVAL') or 300)
+LAG_CHECK_INTERVAL = int(os.getenv('LAG_CHECK_INTERVAL') or 30)
+LAG_ALERT_SECONDS = int(os.getenv('LAG_ALERT_SECONDS') or 600)
+LAG_ALERT_ITEMS = int(os.getenv('LAG_ALERT_ITEMS') or 300)
+SHARD_BOT_TOKENS = os.getenv('SHARD_BOT_TOKENS') or ''
+RECORD_FILE = os.getenv('RECORD_FILE') or ''
 
-# Initialize bot
-bot = Bot(token=TELEGRAM_BOT_TOKEN)
+# Log levels
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LOG_LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LOG_LEVEL = LOG_LEVELS.get((os.getenv('LOG_LEVEL') or 'info').lower(), INFO)
 
+# Initialized by setup()
+bot = None
 
-def log(message):
+
+def log(message, *args, level=INFO):
+    # The message is formatted with the args only if its level is enabled
+    if level < LOG_LEVEL:
+        return
+    if args:
+        message = message % args
     print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} | {message}")
 
-# Function to safely send a message to a chat
-def safe_send_message(chat_id, text, parse_mode=None):
-    global bot
+def debug(message, *args):
+    # Step by step logs of the hot paths. Pass the values as args, not in an f-string, to skip formatting when disabled
+    if DEBUG >= LOG_LEVEL:
+        log(message, *args, level=DEBUG)
+
+
+# Counters and gauges shared by the fetch and processing threads
+metrics = {}
+metrics_lock = threading.Lock()
+
+def metric_inc(name, value=1):
+    with metrics_lock:
+        metrics[name] = metrics.get(name, 0) + value
+
+def metric_set(name, value):
+    with metrics_lock:
+        metrics[name] = value
+
+# Upper bounds in seconds of the stage timing histograms
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Name: [count per bucket, the last one above all bounds, sum, count]
+histograms = {}
+
+def metric_observe(name, value):
+    with metrics_lock:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = [[0] * (len(METRICS_BUCKETS) + 1), 0, 0]
+        histogram[0][bisect.bisect_left(METRICS_BUCKETS, value)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+@contextlib.contextmanager
+def timed(stage):
+    # Time a pipeline stage in the stage_seconds histogram
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metric_observe(f"stage_seconds[stage={stage}]", time.perf_counter() - started)
+
+def histogram_quantile(buckets, count, quantile):
+    # Upper bound of the bucket holding the quantile
+    rank = count * quantile
+    cumulative = 0
+    for bound, bucket_count in zip(METRICS_BUCKETS, buckets):
+        cumulative += bucket_count
+        if cumulative >= rank:
+            return bound
+    return float('inf')
+
+def split_metric_name(name):
+    # "name[key=value]" -> ("nyaa_bot_name", 'key="value"')
+    name, _, label = name.partition('[')
+    if not label:
+        return 'nyaa_bot_' + name, ''
+    key, _, value = label.rstrip(']').partition('=')
+    return 'nyaa_bot_' + name, f'{key}="{value}"'
+
+def render_metrics():
+    # Metrics in the Prometheus text format
+    lines = []
+    with metrics_lock:
+        values = sorted(metrics.items())
+        histogram_values = sorted((name, (list(buckets), total, count)) for name, (buckets, total, count) in histograms.items())
+    for name, value in values:
+        name, label = split_metric_name(name)
+        lines.append(f"{name}{{{label}}} {value}" if label else f"{name} {value}")
+    typed = set()
+    for name, (buckets, total, count) in histogram_values:
+        name, label = split_metric_name(name)
+        if name not in typed:
+            lines.append(f"# TYPE {name} histogram")
+            typed.add(name)
+        separator = ',' if label else ''
+        cumulative = 0
+        for bound, bucket_count in zip(METRICS_BUCKETS + ('+Inf',), buckets):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{{{label}{separator}le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{label}}} {total}")
+        lines.append(f"{name}_count{{{label}}} {count}")
+    return "\n".join(lines) + "\n"
+
+def metrics_summary():
+    # One line of counters and one per timed stage
+    with metrics_lock:
+        values = sorted(metrics.items())
+        histogram_values = sorted((name, (list(buckets), total, count)) for name, (buckets, total, count) in histograms.items())
+    lines = ["Metrics: " + ", ".join(f"{name}={round(value, 3) if isinstance(value, float) else value}" for name, value in values)]
+    for name, (buckets, total, count) in histogram_values:
+        if count:
+            lines.append(f"  {name}: {count} in {total:.2f}s, avg {total / count * 1000:.1f}ms, "
+                         f"p50 <= {histogram_quantile(buckets, count, 0.5)}s, p95 <= {histogram_quantile(buckets, count, 0.95)}s")
+    return "\n".join(lines)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+metrics_server = None
+
+def start_metrics_server():
+    global metrics_server
+    metrics_server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsHandler)
+    metrics_server.daemon_threads = True
+    threading.Thread(target=metrics_server.serve_forever, daemon=True).start()
+    log(f"Metrics served on http://{METRICS_HOST}:{metrics_server.server_port}/metrics")
+
+
+def create_http_session():
+    # Keep-alive session with a connection pool per host and retries with exponential backoff.
+    # 429 and 503 are not retried here: the caller gets the response and its Retry-After,
+    # instead of the thread sleeping through it.
+    retry = Retry(
+        total=HTTP_RETRY_COUNT,
+        backoff_factor=HTTP_RETRY_BACKOFF,
+        status_forcelist=(500, 502, 504),
+        allowed_methods=('GET',),
+        respect_retry_after_header=False
+    )
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+http_session = create_http_session()
+
+class ResponseRecorder:
+    """
+    Append-only log of the HTTP responses received, replayed offline by benchmarks/replay.py.
+    Each record is a fixed header (time, status, flags, sizes), the URL and the headers used
+    by the bot as JSON, then the body, zlib compressed when it's smaller.
+    """
+
+    HEADER = struct.Struct('<dHHII')
+    COMPRESSED = 1
+    HEADERS = ('Content-Type', 'Content-Disposition', 'ETag', 'Last-Modified', 'Retry-After')
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.file = open(path, 'ab')
+
+    def record(self, url, response, body):
+        meta = json.dumps({'url': url, 'headers': {name: response.headers[name] for name in self.HEADERS if name in response.headers}}).encode()
+        flags = 0
+        compressed = zlib.compress(body)
+        if len(compressed) < len(body):
+            body = compressed
+            flags |= self.COMPRESSED
+        with self.lock:
+            self.file.write(self.HEADER.pack(time.time(), response.status_code, flags, len(meta), len(body)) + meta + body)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def read_recorded_responses(path):
+    # Yield the records of a ResponseRecorder log as dicts. A record cut by a crash ends the log.
+    header_size = ResponseRecorder.HEADER.size
+    with open(path, 'rb') as file:
+        while True:
+            header = file.read(header_size)
+            if len(header) < header_size:
+                return
+            timestamp, status, flags, meta_size, body_size = ResponseRecorder.HEADER.unpack(header)
+            meta = file.read(meta_size)
+            body = file.read(body_size)
+            if len(body) < body_size:
+                return
+            meta = json.loads(meta)
+            if flags & ResponseRecorder.COMPRESSED:
+                body = zlib.decompress(body)
+            yield {'time': timestamp, 'url': meta['url'], 'status': status, 'headers': meta['headers'], 'body': body}
+
+# Opened by setup() when RECORD_FILE is set
+response_recorder = None
+
+def http_get(url, timeout, **kwargs):
+    metric_inc('http_requests')
+    response = http_session.get(url, timeout=timeout, **kwargs)
+    # Retries done by urllib3 before this response
+    retries = getattr(response.raw, 'retries', None)
+    if retries is not None and retries.history:
+        metric_inc('http_retries', len(retries.history))
+    if response_recorder is not None:
+        record_response(url, response, kwargs.get('stream'))
+    return response
+
+def record_response(url, response, stream):
+    try:
+        if stream and TORRENT_MAX_SIZE and int(response.headers.get('Content-Length') or 0) > TORRENT_MAX_SIZE:
+            # Not downloaded by the bot, not recorded either
+            return
+        # Reading the body of a streamed response keeps it for iter_content()
+        response_recorder.record(url, response, response.content)
+    except Exception as e:
+        log(f"Error recording response of {url}: {e}", level=WARNING)
+
+def update_http_stats():
+    # Connections opened vs requests served by the pools. The difference is the number of reused connections.
+    opened = 0
+    served = 0
+    for adapter in set(http_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                served += pool.num_requests
+    metric_set('http_connections_opened', opened)
+    metric_set('http_connections_reused', max(served - opened, 0))
+    return opened, served
+
+class TokenBucket:
+    """
+    Token bucket refilled at rate tokens per second, up to capacity tokens.
+    A rate of 0 means no limit. After a RetryAfter the bucket is blocked for the
+    requested time and its rate is halved, then recovers on each successful send.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def refill(self, now):
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        # Seconds to wait before a token is available
+        self.refill(now)
+        wait = max(self.blocked_until - now, 0)
+        if self.rate and self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self):
+        if self.rate:
+            self.tokens -= 1
+
+    def penalize(self, now, retry_after):
+        self.blocked_until = max(self.blocked_until, now + retry_after)
+        self.tokens = 0
+        if self.rate:
+            self.rate = max(self.rate / 2, 1 / 60)
+
+    def recover(self):
+        if self.rate:
+            self.rate = min(self.max_rate, self.rate * 1.1)
+
+
+class Stopping(Exception):
+    # Raised in a thread waiting to send when the bot stops
+    pass
+
+class RateLimiter:
+    """
+    Schedules sends with a token bucket per chat plus a global one.
+    Sends to different chats go back-to-back, waiting only when a bucket is empty.
+    """
+
+    def __init__(self, chat_delay, global_rate):
+        self.chat_rate = 1 / chat_delay if chat_delay > 0 else 0
+        self.global_bucket = TokenBucket(global_rate, capacity=max(int(global_rate), 1))
+        self.chat_buckets = {}
+        self.lock = threading.Lock()
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate)
+        return bucket
+
+    def acquire(self, chat_id):
+        # Block until both the chat and the global bucket have a token, then take them.
+        # Raises Stopping if the bot stops meanwhile.
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                bucket = self.chat_bucket(chat_id)
+                wait = max(bucket.wait_time(now), self.global_bucket.wait_time(now))
+                if wait <= 0:
+                    bucket.take()
+                    self.global_bucket.take()
+                    return
+            if stop_event.wait(wait):
+                raise Stopping()
+
+    def on_success(self, chat_id):
+        with self.lock:
+            self.chat_bucket(chat_id).recover()
+
+    def on_retry_after(self, chat_id, retry_after):
+        with self.lock:
+            self.chat_bucket(chat_id).penalize(time.monotonic(), retry_after)
+
+
+rate_limiter = RateLimiter(DELAY_BETWEEN_SENDS, RATE_LIMIT_GLOBAL)
+
+def send_with_retries(kind, chat_id, send, **kwargs):
+    """
+    Call send, a Bot method, for chat_id within the chat and global rate limits, retrying
+    up to RETRY_COUNT times. kind names what is sent in the logs.
+    """
     max_retries = RETRY_COUNT  # Maximum number of retries to send a message
-    delay = DELAY_BETWEEN_SENDS  # Initial delay between retries
     for attempt in range(max_retries):
-        log(f"Attempt {attempt + 1} of {max_retries} to send message...")
+        debug("Attempt %d of %d to send %s...", attempt + 1, max_retries, kind)
+        if attempt:
+            metric_inc('telegram_retries')
+        rate_limiter.acquire(chat_id)  # Wait for the chat and global rate limits
         try:
-            bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
-            log(f"Sent. Waiting {DELAY_BETWEEN_SENDS} seconds...")
-            time.sleep(delay)  # Delay between messages to prevent rate limit errors
-            break
+            with timed(f"telegram_{send.__name__}"):
+                result = send(chat_id=chat_id, **kwargs)
+            rate_limiter.on_success(chat_id)
+            metric_inc('telegram_sends')
+            debug("Sent.")
+            return result
         except RetryAfter as e:
-            sleep_time = max(delay, e.retry_after)  # Wait for the maximum of the initial delay or the required retry time
-            log(f"Rate limit hit, retrying in {sleep_time} seconds")
-            time.sleep(sleep_time)
+            rate_limiter.on_retry_after(chat_id, e.retry_after)
+            metric_inc('telegram_retry_after')
+            log(f"Rate limit hit on {chat_id}, retrying in {e.retry_after} seconds", level=WARNING)
+        except BadRequest:
+            # The request itself is invalid, retrying won't help
+            raise
         except Exception as e:
-            log(f"Failed to send message on attempt {attempt + 1} due to: {e}")
+            log(f"Failed to send {kind} on attempt {attempt + 1} due to: {e}", level=WARNING)
             if attempt == max_retries - 1:
                 raise
 
+# Function to safely send a message to a chat
+def safe_send_message(chat_id, text, parse_mode=None):
+    return send_with_retries("message", chat_id, bot.send_message, text=text, parse_mode=parse_mode)
+
 # Function to safely send a document to a chat
 def safe_send_document(chat_id, document, caption=None, parse_mode=None):
-    global bot, DELAY_BETWEEN_SENDS
-    max_retries = RETRY_COUNT  # Maximum number of retries to send a message
-    delay = DELAY_BETWEEN_SENDS  # Initial delay between retries
-    for attempt in range(max_retries):
-        log(f"Attempt {attempt + 1} of {max_retries} to send document...")
+    return send_with_retries("document", chat_id, bot.send_document, document=document, caption=caption, parse_mode=parse_mode)
+
+# Function to safely send an album of documents to a chat
+def safe_send_media_group(chat_id, media):
+    return send_with_retries("album", chat_id, bot.send_media_group, media=media)
+
+class TextProcessedStore:
+    """
+    Processed ids saved in a text file, one "id|filename" line per entry, and their
+    deliveries in a second file, one "id|destination" line each. All are loaded in memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.deliveries_path = os.path.splitext(path)[0] + '.deliveries.txt'
+        self.ids = set()
+        self.deliveries = {}
+        # Loaded in the background, lookups wait for it
+        self.loaded = threading.Event()
+        threading.Thread(target=self.load, name='processed-ids', daemon=True).start()
+
+    def load(self):
         try:
-            bot.send_document(chat_id=chat_id, document=document, caption=caption, parse_mode=parse_mode)
-            log(f"Sent. Waiting {DELAY_BETWEEN_SENDS} seconds...")
-            time.sleep(delay)
-            break
-        except RetryAfter as e:
-            sleep_time = max(delay, e.retry_after)
-            log(f"Rate limit hit, retrying in {sleep_time} seconds")
-            time.sleep(sleep_time)
+            if os.path.exists(self.path):
+                # Cut on "|" and get only the number
+                with open(self.path, 'r', encoding="utf-8") as file:
+                    self.ids = set(line.split("|")[0].strip() for line in file)
+            if os.path.exists(self.deliveries_path):
+                with open(self.deliveries_path, 'r', encoding="utf-8") as file:
+                    for line in file:
+                        id, _, destination = line.strip().partition("|")
+                        self.deliveries.setdefault(id, set()).add(destination)
+            log(f"Loaded {len(self.ids)} processed ids.")
         except Exception as e:
-            log(f"Failed to send document on attempt {attempt + 1} due to: {e}")
-            if attempt == max_retries - 1:
-                raise
+            log(f"Error loading {self.path}: {e}", level=ERROR)
+        finally:
+            self.loaded.set()
+
+    def __contains__(self, id):
+        self.loaded.wait()
+        return id in self.ids
+
+    def __len__(self):
+        self.loaded.wait()
+        return len(self.ids)
+
+    def max_id(self):
+        self.loaded.wait()
+        return max((int(id) for id in self.ids if id.isdigit()), default=0)
+
+    def find_by_infohash(self, infohash):
+        # Infohashes are not saved in the text file
+        return []
+
+    def mark_delivered(self, id, destination):
+        self.loaded.wait()
+        self.deliveries.setdefault(id, set()).add(str(destination))
+        with open(self.deliveries_path, 'a', encoding="utf-8") as file:
+            file.write(f"{id}|{destination}\n")
+
+    def delivered(self, id):
+        self.loaded.wait()
+        return set(self.deliveries.get(id, ()))
+
+    def add(self, id, filename, infohash=None):
+        self.loaded.wait()
+        self.ids.add(id)
+        with open(self.path, 'a', encoding="utf-8") as file:
+            file.write(f"{id}|{filename or ''}\n")
 
-start_message = "Nyaa RSS bot " + version + " released on " + released + " started."
-log(start_message)
-safe_send_message(chat_id=ERROR_REPORT_USER_ID, text=start_message)
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteProcessedStore:
+    """
+    Processed ids saved in a SQLite database in WAL mode.
+    Lookups hit the database, so nothing is loaded in memory at startup.
+    Writes are committed in batches of batch_size or on flush().
+    """
+
+    def __init__(self, path, batch_size=20):
+        self.batch_size = batch_size
+        self.uncommitted = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS processed (
+                id INTEGER PRIMARY KEY,
+                infohash TEXT,
+                filename TEXT,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS processed_infohash ON processed (infohash);
+            CREATE TABLE IF NOT EXISTS deliveries (
+                id INTEGER NOT NULL,
+                destination TEXT NOT NULL,
+                sent_at REAL NOT NULL,
+                PRIMARY KEY (id, destination)
+            ) WITHOUT ROWID;
+        """)
+        self.connection.commit()
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def write(self, sql, params=()):
+        with self.lock:
+            self.connection.execute(sql, params)
+            self.uncommitted += 1
+            if self.uncommitted >= self.batch_size:
+                self.connection.commit()
+                self.uncommitted = 0
+
+    def __contains__(self, id):
+        return bool(self.query("SELECT 1 FROM processed WHERE id = ? AND status = 'done'", (int(id),)))
+
+    def __len__(self):
+        return self.query("SELECT COUNT(*) FROM processed")[0][0]
+
+    def max_id(self):
+        return self.query("SELECT MAX(id) FROM processed WHERE status = 'done'")[0][0] or 0
+
+    def find_by_infohash(self, infohash):
+        # Returns the ids already processed with the same infohash
+        return [str(row[0]) for row in self.query("SELECT id FROM processed WHERE infohash = ?", (infohash,))]
+
+    def mark_delivered(self, id, destination):
+        now = time.time()
+        self.write("INSERT OR REPLACE INTO deliveries (id, destination, sent_at) VALUES (?, ?, ?)", (int(id), str(destination), now))
+        self.write("INSERT INTO processed (id, status, created_at, updated_at) VALUES (?, 'partial', ?, ?) "
+                   "ON CONFLICT (id) DO UPDATE SET updated_at = excluded.updated_at", (int(id), now, now))
+
+    def delivered(self, id):
+        return set(row[0] for row in self.query("SELECT destination FROM deliveries WHERE id = ?", (int(id),)))
+
+    def add(self, id, filename, infohash=None):
+        now = time.time()
+        self.write("INSERT INTO processed (id, infohash, filename, status, created_at, updated_at) VALUES (?, ?, ?, 'done', ?, ?) "
+                   "ON CONFLICT (id) DO UPDATE SET infohash = excluded.infohash, filename = COALESCE(excluded.filename, filename), "
+                   "status = 'done', updated_at = excluded.updated_at", (int(id), infohash, filename, now, now))
+
+    def import_text_file(self, path):
+        # One-shot migration from processed_ids.txt, streamed in chunks
+        count = 0
+        now = time.time()
+        with open(path, 'r', encoding="utf-8") as file:
+            while True:
+                rows = []
+                for line in file:
+                    id, _, filename = line.rstrip("\n").partition("|")
+                    if id.strip().isdigit():
+                        rows.append((int(id), filename or None, now, now))
+                    if len(rows) >= 10000:
+                        break
+                if not rows:
+                    break
+                with self.lock:
+                    self.connection.executemany("INSERT OR IGNORE INTO processed (id, filename, status, created_at, updated_at) "
+                                                "VALUES (?, ?, 'done', ?, ?)", rows)
+                    self.connection.commit()
+                count += len(rows)
+        return count
+
+    def flush(self):
+        with self.lock:
+            if self.uncommitted:
+                self.connection.commit()
+                self.uncommitted = 0
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.connection.close()
+
+
+def open_processed_store():
+    if PROCESSED_STORE == 'text':
+        log("Loading processed_ids file in the background...")
+        return TextProcessedStore(processed_file_path)
+    log("Opening processed ids database...")
+    store = SQLiteProcessedStore(PROCESSED_DB_PATH, PROCESSED_STORE_BATCH_SIZE)
+    if os.path.exists(processed_file_path) and not store.max_id():
+        log("Migrating processed_ids file to the database...")
+        log(f"Migrated {store.import_text_file(processed_file_path)} ids.")
+    log("Opened.")
+    return store
 
-# Create downloads folder if not exists
-log("Creating downloads folder if not exists...")
-if not os.path.exists(DOWNLOAD_PATH):
-    os.makedirs(DOWNLOAD_PATH)
-log("Done.")
 
-# Load processed IDs from file. Cut on "|" and get only the number
-log("Loading processed_ids file...")
 processed_file_path = 'processed_ids.txt'
-if os.path.exists(processed_file_path):
-    with open(processed_file_path, 'r', encoding="utf-8") as file:
-        processed_ids = set(line.split("|")[0].strip() for line in file)
-    log("Loaded.")
-else:
-    log("File not found. Creating empty set.")
-    processed_ids = set()
+# Opened by setup()
+processed_store = None
+# Highest processed id, used to stop parsing the feed early
+max_processed_id = 0
+# Ids that failed processing and must be parsed again on next fetch
+failed_ids = set()
+# Guards max_processed_id and failed_ids, shared by the poll, send, backfill and shard result threads
+state_lock = threading.Lock()
+
+# Uploaded file_ids, to send torrents already uploaded without uploading them again
+file_ids_by_id = {}
+file_ids_by_hash = {}
+# Cleared while the cache is loaded in the background
+file_ids_loaded = threading.Event()
+file_ids_loaded.set()
+
+def load_file_id_cache():
+    log("Loading file_id cache...")
+    try:
+        if os.path.exists(FILE_ID_CACHE):
+            with open(FILE_ID_CACHE, 'r', encoding="utf-8") as file:
+                for line in file:
+                    parts = line.strip().split("|")
+                    if len(parts) == 3:
+                        file_ids_by_id[parts[0]] = parts[2]
+                        file_ids_by_hash[parts[1]] = parts[2]
+        log(f"Loaded {len(file_ids_by_id)} file_ids.")
+    except Exception as e:
+        log(f"Error loading file_id cache: {e}", level=ERROR)
+    finally:
+        file_ids_loaded.set()
+
+def get_cached_file_id(id, infohash):
+    file_ids_loaded.wait()
+    return file_ids_by_id.get(id) or file_ids_by_hash.get(infohash)
+
+def cache_file_id(id, infohash, file_id):
+    file_ids_loaded.wait()
+    file_ids_by_id[id] = file_id
+    file_ids_by_hash[infohash] = file_id
+    if FILE_ID_CACHE:
+        with open(FILE_ID_CACHE, 'a', encoding="utf-8") as file:
+            file.write(f"{id}|{infohash}|{file_id}\n")
+
+def is_uploaded(entry):
+    # Processed entries queued again for other feeds are sent with their cached file_id
+    id = get_entry_id(entry)
+    return id in processed_store and get_cached_file_id(id, entry['nyaa_infohash']) is not None
+
+def uncache_file_id(id, infohash):
+    # The cached file_id was refused by Telegram. The file will be uploaded again.
+    file_ids_by_id.pop(id, None)
+    file_ids_by_hash.pop(infohash, None)
 
-# Load category-channel mappings from environment variable
-log("Loading category-channel mappings...")
-category_channel_mappings_str = os.getenv('CATEGORY_CHANNEL_MAPPINGS')
 category_channel_mappings = []
-for mapping_str in category_channel_mappings_str.split(','):
-    category, channel, enabled = mapping_str.split('|')
-    category_channel_mappings.append(CategoryChannel(category, channel, enabled == '1'))
-    log(f"Loaded: {category} -> {channel} ({'Enabled' if enabled == '1' else 'Disabled'})")
-log("Loaded.")
+
+def load_category_channel_mappings():
+    # Load category-channel mappings from environment variable
+    log("Loading category-channel mappings...")
+    category_channel_mappings_str = os.getenv('CATEGORY_CHANNEL_MAPPINGS') or ''
+    for mapping_str in category_channel_mappings_str.split(','):
+        if not mapping_str:
+            continue
+        category, channel, enabled = mapping_str.split('|')
+        category_channel_mappings.append(CategoryChannel(category, channel, enabled == '1'))
+        log(f"Loaded: {category} -> {channel} ({'Enabled' if enabled == '1' else 'Disabled'})")
+    log("Loaded.")
+
+
+class TitleMatcher:
+    """
+    Aho-Corasick automaton: finds all the patterns contained in a text in a single pass,
+    whatever the number of patterns.
+    """
+
+    def __init__(self, patterns):
+        # Trie of the patterns: transitions, fail links and indexes of the patterns ending at each node
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for index, pattern in enumerate(patterns):
+            node = 0
+            for char in pattern:
+                next_node = self.goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self.goto)
+                    self.goto[node][char] = next_node
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                node = next_node
+            self.output[node].append(index)
+        # Breadth first, the fail link of a node points to its longest proper suffix in the trie
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, next_node in self.goto[node].items():
+                queue.append(next_node)
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_node] = self.goto[fail].get(char, 0)
+                self.output[next_node] = self.output[next_node] + self.output[self.fail[next_node]]
+
+    def search(self, text):
+        # Indexes of the patterns found in text
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        found = set()
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node]:
+                found.update(output[node])
+        return found
+
+SIZE_UNITS = {'B': 1, 'Bytes': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3, 'TiB': 1024 ** 4}
+
+def parse_size(size):
+    # "1.4 GiB" -> bytes
+    if isinstance(size, (int, float)):
+        return size
+    number, _, unit = size.strip().partition(' ')
+    return float(number) * SIZE_UNITS[unit.strip() or 'B']
+
+def as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+class RoutingRule:
+    """
+    Send the entries matching all the conditions of the rule to channel:
+    title literals all contained in the title, no exclude literal, regex, category
+    (an id like 1_2, or 1_0 for a whole main category), trusted and remake flags, size bounds.
+    """
+
+    def __init__(self, channel, title=None, exclude=None, regex=None, category=None,
+                 trusted=None, remake=None, min_size=None, max_size=None, enabled=True):
+        self.channel = str(channel)
+        self.titles = [literal.lower() for literal in as_list(title)]
+        self.excludes = [literal.lower() for literal in as_list(exclude)]
+        self.regex = re.compile(regex, re.IGNORECASE) if regex else None
+        self.categories = set(as_list(category))
+        self.trusted = trusted
+        self.remake = remake
+        self.min_size = parse_size(min_size) if min_size is not None else None
+        self.max_size = parse_size(max_size) if max_size is not None else None
+        self.enabled = enabled
+        # Position, literal indexes and combined regex gate, set by RuleEngine
+        self.order = 0
+        self.title_ids = ()
+        self.exclude_ids = ()
+        self.gated = False
+
+    def matches(self, entry, found):
+        # found: indexes of the literals contained in the title
+        if self.categories and not self.categories & category_keys(entry['nyaa_categoryid']):
+            return False
+        if not found.issuperset(self.title_ids) or not found.isdisjoint(self.exclude_ids):
+            return False
+        if self.trusted is not None and (entry.get('nyaa_trusted') == 'Yes') != self.trusted:
+            return False
+        if self.remake is not None and (entry.get('nyaa_remake') == 'Yes') != self.remake:
+            return False
+        if self.min_size is not None or self.max_size is not None:
+            try:
+                size = parse_size(entry['nyaa_size'])
+            except Exception:
+                return False
+            if self.min_size is not None and size < self.min_size:
+                return False
+            if self.max_size is not None and size > self.max_size:
+                return False
+        if self.regex is not None and not self.regex.search(entry['title']):
+            return False
+        return True
+
+REGEX_SPECIAL_CHARS = set('.^$*+?{}[]\\|()')
+INLINE_FLAGS = re.compile(r'\(\?[aiLmsux]+\)')
+
+def regex_literal(pattern):
+    # Literal text every match of the pattern starts with, lowercase. Empty if there is none.
+    if '|' in pattern:
+        return ''
+    literal = ''
+    for index, char in enumerate(pattern):
+        if char in REGEX_SPECIAL_CHARS:
+            # A quantifier applies to the last char, which is then optional
+            if char in '*?{' and literal:
+                literal = literal[:-1]
+            break
+        literal += char
+    return literal.lower()
+
+def category_keys(category_id):
+    # The category and its main category: 1_2 -> {1_2, 1_0}
+    return {category_id, category_id.split('_')[0] + '_0'}
+
+class RuleEngine:
+    """
+    Compiled routing rules. All the title literals of all the rules are matched at once by
+    an Aho-Corasick automaton, and a rule is only evaluated if its first title literal was
+    found. Rules without title literals are indexed by category, and the ones with a regex
+    only are skipped when the combined regex of all of them doesn't match. Regexes with
+    groups or global inline flags can't be combined and are evaluated one by one. The cost per
+    entry depends on the title length and the matching rules, not on the number of rules.
+    """
+
+    def __init__(self, rules):
+        self.rules = [rule for rule in rules if rule.enabled]
+        literals = {}
+        for order, rule in enumerate(self.rules):
+            rule.order = order
+            # The literal prefix of the regex is also required in the title
+            required = rule.titles + [literal for literal in [regex_literal(rule.regex.pattern) if rule.regex else ''] if len(literal) >= 3]
+            rule.title_ids = tuple(literals.setdefault(literal, len(literals)) for literal in required)
+            rule.exclude_ids = tuple(literals.setdefault(literal, len(literals)) for literal in rule.excludes)
+        self.matcher = TitleMatcher(list(literals))
+        self.by_literal = collections.defaultdict(list)
+        self.by_category = collections.defaultdict(list)
+        gated = []
+        # Index each rule by its least used literal, to evaluate as few rules as possible
+        usage = collections.Counter(index for rule in self.rules for index in rule.title_ids)
+        for rule in self.rules:
+            if rule.title_ids:
+                self.by_literal[min(rule.title_ids, key=lambda index: usage[index])].append(rule)
+                continue
+            for category in rule.categories or ['']:
+                self.by_category[category].append(rule)
+            # Group numbers, names and backreferences would change in the combined regex, and
+            # global inline flags like (?i) are only allowed at the start of a regex
+            if rule.regex is not None and not rule.regex.groups and not INLINE_FLAGS.match(rule.regex.pattern):
+                gated.append(rule)
+        self.regex = None
+        if gated:
+            try:
+                self.regex = re.compile('|'.join(f"(?:{rule.regex.pattern})" for rule in gated), re.IGNORECASE)
+            except re.error:
+                gated = []
+        for rule in gated:
+            rule.gated = True
+        self.literals = len(literals)
+
+    def match(self, entry):
+        # Channels of the rules matching the entry, in rules order
+        title = entry['title'] or ''
+        found = self.matcher.search(title.lower())
+        candidates = []
+        for index in found:
+            candidates.extend(self.by_literal.get(index, ()))
+        regex_matched = self.regex is not None and self.regex.search(title) is not None
+        for category in [''] + list(category_keys(entry['nyaa_categoryid'])):
+            for rule in self.by_category.get(category, ()):
+                if not rule.gated or regex_matched:
+                    candidates.append(rule)
+        channels = []
+        for rule in sorted(candidates, key=lambda rule: rule.order) if len(candidates) > 1 else candidates:
+            if rule.channel not in channels and rule.matches(entry, found):
+                channels.append(rule.channel)
+        return channels
+
+# Loaded by setup() from ROUTING_RULES_FILE
+routing_rules = None
+
+def load_routing_rules():
+    global routing_rules
+    log(f"Loading routing rules from {ROUTING_RULES_FILE}...")
+    with open(ROUTING_RULES_FILE, 'r', encoding='utf-8') as file:
+        routing_rules = RuleEngine([RoutingRule(**rule) for rule in json.load(file)])
+    log(f"Loaded {len(routing_rules.rules)} rules with {routing_rules.literals} title patterns.")
 
 
 def sanitize_filename(filename):
@@ -182,139 +1168,799 @@ def sanitize_filename(filename):
     return sanitized
 
 
-def generate_unique_filename(file_name, file_ext, id):
-    global DOWNLOAD_PATH
-    # Calculate the folder name based on the id
-    folder_name = f"{int(id) // 1000}xxx"  # Integer division to get the base and append 'xxx'
-    folder_path = os.path.join(DOWNLOAD_PATH, folder_name)
+class TorrentStorage:
+    """
+    Torrent files saved once, as root/NNNNxxx/<id>-<name>.torrent.
+    Paths are indexed in memory by id, each shard folder being listed once on first use
+    instead of probing the files of every entry, and by infohash, so a torrent already
+    stored under any id is not downloaded again. Files are written atomically.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        # Shard folder name -> {id: path}
+        self.shards = {}
+        self.by_infohash = {}
+        # Maximum allowed filename length taken from the OS
+        try:
+            self.name_max = os.pathconf(root, 'PC_NAME_MAX')
+        except Exception:
+            self.name_max = 255
+
+    def shard(self, id):
+        # Folder and index of the shard of id, created and listed the first time
+        folder_name = f"{int(id) // 1000}xxx"  # Integer division to get the base and append 'xxx'
+        folder_path = os.path.join(self.root, folder_name)
+        with self.lock:
+            index = self.shards.get(folder_name)
+        if index is None:
+            os.makedirs(folder_path, exist_ok=True)
+            index = {}
+            with os.scandir(folder_path) as dir_entries:
+                for dir_entry in dir_entries:
+                    # Skip the temporary files of interrupted writes
+                    if not dir_entry.name.startswith('.'):
+                        index.setdefault(dir_entry.name.split('-', 1)[0], dir_entry.path)
+            with self.lock:
+                index = self.shards.setdefault(folder_name, index)
+        return folder_path, index
+
+    def find(self, id, infohash=None):
+        # Path of the stored torrent of id, or of the same infohash under another id
+        _, index = self.shard(id)
+        path = index.get(str(id))
+        if path is None and infohash:
+            with self.lock:
+                path = self.by_infohash.get(infohash)
+            if path is None:
+                for other_id in processed_store.find_by_infohash(infohash):
+                    if other_id != str(id):
+                        path = self.shard(other_id)[1].get(other_id)
+                        if path is not None:
+                            break
+        if path is not None and infohash:
+            with self.lock:
+                self.by_infohash[infohash] = path
+        return path
 
-    # Ensure the folder exists
-    os.makedirs(folder_path, exist_ok=True)
+    def save(self, id, infohash, file_name, file_ext, chunks, max_size=0):
+        """
+        Write the chunks to a temporary file, up to max_size bytes (0 for no limit), check it's
+        a torrent and rename it. Raises TorrentTooLarge or ValueError, leaving no file behind.
+        """
+        folder_path, index = self.shard(id)
+        id = str(id)
+        path = index.get(id)
+        if path is not None:
+            return path
+        # Prepend the id to the filename and shorten it if too long for the OS
+        full_filename = f"{id}-{file_name}{file_ext}"
+        if len(full_filename.encode()) > self.name_max:
+            remaining_length = self.name_max - len(file_ext.encode()) - len(id) - 1
+            file_name = file_name.encode()[:remaining_length].decode(errors='ignore')
+            full_filename = f"{id}-{file_name}{file_ext}"
+        path = os.path.join(folder_path, full_filename)
+        temp_path = os.path.join(folder_path, f".{id}.{threading.get_ident()}.tmp")
+        size = 0
+        write_time = 0
+        try:
+            with open(temp_path, 'wb') as f:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if max_size and size > max_size:
+                        raise TorrentTooLarge(f"Torrent file {id} is larger than {max_size} bytes.")
+                    started = time.perf_counter()
+                    f.write(chunk)
+                    write_time += time.perf_counter() - started
+            started = time.perf_counter()
+            validate_torrent_file(temp_path)
+            os.replace(temp_path, path)
+            metric_observe("stage_seconds[stage=disk_write]", write_time + time.perf_counter() - started)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        with self.lock:
+            index[id] = path
+            if infohash:
+                self.by_infohash[infohash] = path
+        return path
+
+class TorrentTooLarge(Exception):
+    pass
 
-    # Prepend the "id" variable to the filename
-    full_filename = f"{id}-{file_name}{file_ext}"
+def validate_bencode(data):
+    """
+    Check that data (bytes or mmap) is a bencoded dictionary with an info key, as .torrent files are.
+    The structure is walked without decoding the values. Raises ValueError.
+    """
+    size = len(data)
+    if data[:1] != b'd':
+        raise ValueError("not a bencoded dictionary")
+    # Open containers as [type, True if the next item of a dictionary is a key]
+    stack = []
+    has_info = False
+    # True while the value of the info key is expected
+    info_value = False
+    index = 0
+    while True:
+        if index >= size:
+            raise ValueError("truncated data")
+        token = data[index:index + 1]
+        expecting_key = bool(stack) and stack[-1][0] == b'd' and stack[-1][1]
+        if info_value and token != b'd':
+            raise ValueError("info is not a dictionary")
+        if token == b'e' and stack:
+            if stack[-1][0] == b'd' and not expecting_key:
+                raise ValueError("dictionary key without value")
+            stack.pop()
+            index += 1
+            if not stack:
+                break
+        elif expecting_key and not token.isdigit():
+            raise ValueError("dictionary key is not a string")
+        elif token in (b'd', b'l'):
+            info_value = False
+            stack.append([token, True])
+            index += 1
+            continue
+        elif token == b'i':
+            end = data.find(b'e', index)
+            if end < 0:
+                raise ValueError("truncated data")
+            int(data[index + 1:end])
+            index = end + 1
+        elif token.isdigit():
+            colon = data.find(b':', index, index + 21)
+            if colon < 0:
+                raise ValueError("invalid string length")
+            start = colon + 1
+            index = start + int(data[index:colon])
+            if index > size:
+                raise ValueError("truncated data")
+            if len(stack) == 1 and expecting_key and data[start:index] == b'info':
+                has_info = True
+                info_value = True
+        else:
+            raise ValueError(f"invalid token at byte {index}")
+        # An item is complete: in a dictionary a key is followed by a value and vice versa
+        if stack[-1][0] == b'd':
+            stack[-1][1] = not stack[-1][1]
+    if index != size:
+        raise ValueError("data after the end of the dictionary")
+    if not has_info:
+        raise ValueError("no info dictionary")
+
+def validate_torrent_file(path):
+    # Map the file instead of reading it in memory
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError("empty file")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            validate_bencode(data)
+
+# Initialized by setup()
+torrent_storage = None
+
+
+def get_entry_id(entry):
+    # Parse ID from GUID URL
+    return urlparse(entry['guid']).path.split('/')[-1]
+
+
+class QueueJournal:
+    """
+    Append-only journal of the queued entries and of their deliveries, one JSON record per line.
+    Replayed on startup to resume the pending entries, skipping the destinations already delivered.
+    Compacted by rewriting only the entries not yet saved in the processed store.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.sent = {}
+        self.records = 0
+        partial = False
+        if os.path.exists(path):
+            partial = self.load()
+        self.file = open(path, 'a', encoding="utf-8")
+        if partial:
+            # Terminate the partial line so the next record starts on its own line
+            self.file.write("\n")
+
+    def load(self):
+        # Returns True if the last line was only partially written
+        line = "\n"
+        with open(self.path, 'r', encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Partial line written during a crash
+                    continue
+                if record['op'] == 'put':
+                    self.entries[get_entry_id(record['entry'])] = record['entry']
+                elif record['op'] == 'sent':
+                    self.sent.setdefault(record['id'], set()).add(record['destination'])
+                self.records += 1
+        return not line.endswith("\n")
+
+    def write(self, records):
+        for record in records:
+            self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.records += len(records)
+
+    def record_put(self, entries):
+        with self.lock:
+            for entry in entries:
+                self.entries[get_entry_id(entry)] = entry
+            self.write([{'op': 'put', 'entry': entry} for entry in entries])
+
+    def record_sent(self, id, destination):
+        with self.lock:
+            self.sent.setdefault(id, set()).add(str(destination))
+            self.write([{'op': 'sent', 'id': id, 'destination': str(destination)}])
+
+    def delivered(self, id):
+        with self.lock:
+            return set(self.sent.get(id, ()))
+
+    def pending_entries(self):
+        with self.lock:
+            return list(self.entries.values())
+
+    def compact(self, is_done):
+        # Rewrite the journal without the entries is_done() reports as saved
+        with self.lock:
+            for id in [id for id in self.entries if is_done(id)]:
+                del self.entries[id]
+            self.sent = {id: sent for id, sent in self.sent.items() if id in self.entries}
+            records = [{'op': 'put', 'entry': entry} for entry in self.entries.values()]
+            for id, sent in self.sent.items():
+                records.extend({'op': 'sent', 'id': id, 'destination': destination} for destination in sent)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, 'w', encoding="utf-8") as file:
+                for record in records:
+                    file.write(json.dumps(record) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            self.file.close()
+            os.replace(temp_path, self.path)
+            self.file = open(self.path, 'a', encoding="utf-8")
+            self.records = len(records)
+
+
+class EntryQueue:
+    """
+    Work queue between the feed fetchers and the processing thread.
+    Entries are deduplicated by nyaa id: an entry already queued or in-flight gets the
+    destinations of the new one, a processed entry is queued again only for the
+    destinations not delivered yet. Entries are returned in id order and at most max_size
+    entries are queued. When full, the newest entries, even if already queued, are moved to
+    an overflow and queued again in id order as the queue drains. They are journaled like
+    the queued ones, so none is lost when it leaves the feed window.
+    """
 
-    # Maximum allowed filename length taken from the OS
+    def __init__(self, max_size, pending_destinations, journal=None):
+        self.max_size = max_size
+        self.pending_destinations = pending_destinations
+        self.journal = journal
+        self.heap = []  # (int id, str id)
+        self.queued = {}
+        # Entries waiting for room in the queue, heap and entries by id
+        self.overflow_heap = []
+        self.overflow = {}
+        self.in_flight = {}
+        # Destinations added to in-flight entries, queued again when they are done
+        self.late_destinations = {}
+        # Entries with id at or above a held id are not returned until it's released
+        self.holds = collections.Counter()
+        self.closed = False
+        self.condition = threading.Condition()
+        # Called from any thread when entries may have become ready
+        self.listener = None
+
+    def notify(self):
+        # Wake up the threads waiting in get() and the listener. Call holding the condition.
+        self.condition.notify_all()
+        if self.listener is not None:
+            self.listener()
+
+    def put(self, entries, journal=True):
+        # Returns the number of added entries and of entries moved to the overflow
+        added = []
+        overflowed = 0
+        skipped = 0
+        with self.condition:
+            for entry in entries:
+                id = get_entry_id(entry)
+                destinations = entry.get('destinations') or get_default_destinations(entry)
+                if id in self.queued or id in self.overflow:
+                    queued = self.queued.get(id) or self.overflow[id]
+                    new_destinations = [destination for destination in destinations if destination not in queued['destinations']]
+                    if new_destinations:
+                        queued['destinations'] = queued['destinations'] + new_destinations
+                        added.append(queued)
+                    else:
+                        skipped += 1
+                    continue
+                if id in self.in_flight:
+                    new_destinations = [destination for destination in destinations if destination not in self.in_flight[id]['destinations']]
+                    if new_destinations:
+                        self.late_destinations.setdefault(id, []).extend(new_destinations)
+                    else:
+                        skipped += 1
+                    continue
+                destinations = self.pending_destinations(id, destinations)
+                if not destinations:
+                    skipped += 1
+                    continue
+                item = (int(id), id)
+                entry = dict(entry, destinations=destinations)
+                added.append(entry)
+                if len(self.heap) >= self.max_size:
+                    newest = max(self.heap)
+                    if item > newest:
+                        self.add_overflow(item, entry)
+                        overflowed += 1
+                        continue
+                    # Make room for an older entry by moving the newest queued one to the overflow
+                    self.heap.remove(newest)
+                    heapq.heapify(self.heap)
+                    self.add_overflow(newest, self.queued.pop(newest[1]))
+                    overflowed += 1
+                heapq.heappush(self.heap, item)
+                self.queued[id] = entry
+            if added:
+                if journal and self.journal is not None:
+                    self.journal.record_put(added)
+                self.notify()
+        if skipped:
+            metric_inc('dedup_skips', skipped)
+        return len(added), overflowed
+
+    def add_overflow(self, item, entry):
+        # Call holding the condition
+        heapq.heappush(self.overflow_heap, item)
+        self.overflow[item[1]] = entry
+
+    def refill(self):
+        # Queue the oldest overflow entries while there is room. Call holding the condition.
+        while self.overflow_heap and len(self.heap) < self.max_size:
+            item = heapq.heappop(self.overflow_heap)
+            heapq.heappush(self.heap, item)
+            self.queued[item[1]] = self.overflow.pop(item[1])
+
+    def ready(self):
+        return bool(self.heap) and (not self.holds or self.heap[0][0] < min(self.holds))
+
+    def hold(self, id):
+        # Keep entries from id onwards in the queue until release(id), so id can be added and returned first
+        with self.condition:
+            self.holds[id] += 1
+
+    def release(self, id):
+        with self.condition:
+            self.holds[id] -= 1
+            if self.holds[id] <= 0:
+                del self.holds[id]
+            self.notify()
+
+    def get(self, timeout=None):
+        # Wait for the oldest entry and mark it as in-flight. Returns None on timeout.
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.closed or self.ready(), timeout=timeout) or self.closed:
+                return None
+            _, id = heapq.heappop(self.heap)
+            entry = self.in_flight[id] = self.queued.pop(id)
+            self.refill()
+            return entry
+
+    def task_done(self, entry):
+        # Release the in-flight id. Entries not marked as processed can be queued again.
+        id = get_entry_id(entry)
+        with self.condition:
+            self.in_flight.pop(id, None)
+            late_destinations = self.late_destinations.pop(id, None)
+        if late_destinations:
+            self.put([dict(entry, destinations=late_destinations)])
+
+    def take_late_destinations(self, id):
+        # Destinations added while the entry is in-flight, to send them in the same run
+        with self.condition:
+            return self.late_destinations.pop(id, [])
+
+    def close(self):
+        # Wake up the waiting consumers. Queued entries are kept in the journal.
+        with self.condition:
+            self.closed = True
+            self.notify()
+
+    def backlog(self):
+        # Number of queued and in-flight entries and the time the oldest one was seen by the poller
+        with self.condition:
+            entries = list(self.in_flight.values())
+            if self.heap:
+                entries.append(self.queued[self.heap[0][1]])
+            seen = [entry['seen_at'] for entry in entries if entry.get('seen_at')]
+            return len(self.heap) + len(self.overflow) + len(self.in_flight), min(seen, default=None)
+
+    def __len__(self):
+        with self.condition:
+            return len(self.heap) + len(self.overflow)
+
+    def __contains__(self, id):
+        with self.condition:
+            return id in self.queued or id in self.overflow or id in self.in_flight
+
+
+# Opened by setup()
+queue_journal = None
+entry_queue = None
+
+def open_entry_queue():
+    global entry_queue
+    entry_queue = EntryQueue(QUEUE_MAX_SIZE, get_pending_destinations)
+
+def restore_state():
+    """
+    Load the state of the previous run, in the background while the first feed fetches
+    are in progress: the highest processed id, where parsing stops, and the entries of the
+    queue journal. fetch_rss_feed() waits for it before parsing.
+    """
+    global max_processed_id, queue_journal
     try:
-        max_filename_length = os.pathconf(folder_path, 'PC_NAME_MAX')
-    except:
-        max_filename_length = 255
+        stored_max_id = processed_store.max_id()
+        with state_lock:
+            max_processed_id = max(max_processed_id, stored_max_id)
+        feeds[0].last_id = max(feeds[0].last_id, max_processed_id)
+        if QUEUE_JOURNAL:
+            queue_journal = entry_queue.journal = QueueJournal(QUEUE_JOURNAL)
+            # Resume the entries pending when the bot stopped
+            resumed, _ = entry_queue.put(queue_journal.pending_entries(), journal=False)
+            log(f"Resumed {resumed} entries from the queue journal.")
+    except Exception as e:
+        error_message = str(e) + "\n\n" + traceback.format_exc()
+        log("Error restoring state: " + error_message, level=ERROR)
+        safe_send_message(chat_id=ERROR_REPORT_USER_ID, text="Error restoring state: " + error_message)
+    finally:
+        state_restored.set()
 
-    # Build the full file path
-    file_path = os.path.join(folder_path, full_filename)
+# Set by restore_state()
+state_restored = threading.Event()
 
-    counter = 1
+def get_default_destinations(entry):
+    # Global channel and the enabled channels of the entry category
+    send_to = [TELEGRAM_CHANNEL_ID]
+    for mapping in category_channel_mappings:
+        if mapping.category == entry['nyaa_categoryid'] and mapping.enabled:
+            send_to.append(mapping.channel)
+    if routing_rules is not None:
+        send_to += [channel for channel in routing_rules.match(entry) if channel not in send_to]
+    return send_to
 
-    while os.path.exists(file_path):
-        # Define a new filename with a counter
-        new_file_name = f"{id}-{file_name}_{counter}{file_ext}"
-        
-        # Check if the total length is too long and shorten the file_name section
-        if len(new_file_name) > max_filename_length:
-            remaining_length = max_filename_length - len(file_ext) - len(str(id)) - 3  # Account for "|", "_", and "."
-            file_name = file_name[:remaining_length]
-            new_file_name = f"{id}-{file_name}_{counter}{file_ext}"
+def get_pending_destinations(id, destinations):
+    # Destinations not delivered yet. Entries processed without delivery records count as fully delivered.
+    if id not in processed_store:
+        return destinations
+    delivered = processed_store.delivered(id)
+    return [destination for destination in destinations if delivered and str(destination) not in delivered]
 
-        file_path = os.path.join(folder_path, new_file_name)
+def iter_destinations(id, send_to):
+    # Yield the destinations of an entry, plus the ones added by other feeds while it's being sent
+    index = 0
+    while True:
+        while index < len(send_to):
+            yield send_to[index]
+            index += 1
+        late_destinations = [destination for destination in entry_queue.take_late_destinations(id) if destination not in send_to]
+        if not late_destinations:
+            return
+        send_to.extend(late_destinations)
+
+def get_undelivered_destinations(entry):
+    id = get_entry_id(entry)
+    send_to = entry.get('destinations') or get_default_destinations(entry)
+    already_sent = processed_store.delivered(id)
+    if queue_journal is not None:
+        already_sent |= queue_journal.delivered(id)
+    if already_sent:
+        send_to = [destination for destination in send_to if str(destination) not in already_sent]
+        debug("Already delivered %s to %d destinations. %d left.", id, len(already_sent), len(send_to))
+    return send_to
 
-        counter += 1
+def mark_delivered(id, destination):
+    record_first('post')
+    if queue_journal is not None:
+        queue_journal.record_sent(id, destination)
+    processed_store.mark_delivered(id, destination)
 
-    return file_path
+def compact_queue_journal():
+    # Entries are dropped from the journal only once committed to the processed store
+    processed_store.flush()
+    queue_journal.compact(lambda id: id in processed_store)
 
+NYAA_NS = '{https://nyaa.si/xmlns/nyaa}'
 
-# Global list to store RSS entries
-rss_entries = []
+# Map of RSS item child tags to entry keys
+ITEM_FIELDS = {
+    'title': 'title',
+    'link': 'link',
+    'guid': 'guid',
+    'pubDate': 'published',
+    NYAA_NS + 'infoHash': 'nyaa_infohash',
+    NYAA_NS + 'categoryId': 'nyaa_categoryid',
+    NYAA_NS + 'category': 'nyaa_category',
+    NYAA_NS + 'size': 'nyaa_size',
+    NYAA_NS + 'trusted': 'nyaa_trusted',
+    NYAA_NS + 'remake': 'nyaa_remake'
+}
 
-def fetch_latest_rss_entry():
-    last_id = 0
+def parse_feed_items(content, stop_at_id=0):
+    """
+    Stream-parse the RSS items, newest first.
+    Parsing stops at the first item with id lower or equal to stop_at_id.
+    Returns the parsed entries and True if parsing stopped early.
+    """
+    entries = []
+    for event, element in ET.iterparse(io.BytesIO(content), events=('end',)):
+        if element.tag != 'item':
+            continue
+        entry = dict.fromkeys(ITEM_FIELDS.values())
+        for child in element:
+            key = ITEM_FIELDS.get(child.tag)
+            if key:
+                entry[key] = child.text
+        element.clear()
+        if int(get_entry_id(entry)) <= stop_at_id:
+            return entries, True
+        entries.append(entry)
+    return entries, False
+
+
+# Polled feeds, loaded by setup()
+feeds = []
+poll_executor = None
+
+def load_feeds():
+    # The main feed plus the FEEDS ones, in the "url|interval|channel1;channel2" format separated by commas
+    global poll_executor
+    log("Loading feeds...")
+    main_feed = Feed(FEED_URL, CHECK_INTERVAL, backfill=BACKFILL_ENABLED)
+    feeds.append(main_feed)
+    for feed_str in FEEDS.split(','):
+        if not feed_str:
+            continue
+        url, interval, destinations = (feed_str + '||').split('|')[:3]
+        destinations = [destination for destination in destinations.split(';') if destination]
+        feeds.append(Feed(url, int(interval or CHECK_INTERVAL), destinations or None, name=f"feed{len(feeds)}"))
+    for feed in feeds:
+        if POLL_ADAPTIVE:
+            feed.set_interval(feed.interval)
+        metric_set(f"poll_interval[feed={feed.name}]", feed.interval)
+        log(f"Loaded: {feed.url} every {feed.interval} seconds -> {'default channels' if feed.destinations is None else ', '.join(feed.destinations)}")
+    poll_executor = ThreadPoolExecutor(max_workers=len(feeds), thread_name_prefix='poll')
+    log("Loaded.")
+
+def reset_feed_cache():
+    # Force the next fetch of every feed to download and parse the whole feed again
+    for feed in feeds:
+        feed.reset_cache()
+
+def get_stop_at_id(feed):
+    # Items at or below this id are already queued and can be skipped. Failed ids older than
+    # the feed window are not parsed again, unless the gap is backfilled.
+    with state_lock:
+        failed = [int(id) for id in failed_ids]
+    return min([feed.last_id] + [id - 1 for id in failed if feed.backfill or id >= feed.oldest_id])
+
+# Patterns to read an entry from the nyaa view page
+VIEW_TITLE_PATTERN = re.compile(r'<h3 class="panel-title">\s*(.*?)\s*</h3>', re.DOTALL)
+VIEW_CATEGORY_PATTERN = re.compile(r'href="/\?c=(\d+_\d+)">([^<]*)</a>')
+VIEW_TIMESTAMP_PATTERN = re.compile(r'data-timestamp="(\d+)"')
+VIEW_SIZE_PATTERN = re.compile(r'File size:</div>\s*<div[^>]*>([^<]*)</div>')
+VIEW_INFOHASH_PATTERN = re.compile(r'<kbd>([0-9a-fA-F]{40})</kbd>')
+
+backfill_executor = ThreadPoolExecutor(max_workers=BACKFILL_WORKERS, thread_name_prefix='backfill')
+# BACKFILL_RATE 0 doesn't limit the backfill requests
+backfill_limiter = RateLimiter(1 / BACKFILL_RATE if BACKFILL_RATE > 0 else 0, 0)
+# Ids being backfilled and ids not available on nyaa (deleted or hidden)
+backfill_ids = set()
+backfill_missing_ids = set()
+backfill_lock = threading.Lock()
+
+def update_backlog_metrics():
+    with backfill_lock:
+        backfill_pending = len(backfill_ids)
+    metric_set('queue_size', len(entry_queue))
+    metric_set('backfill_pending', backfill_pending)
+    metric_set('backlog_size', len(entry_queue) + backfill_pending)
+
+def fetch_view_entry(id):
+    """
+    Build an entry like the feed ones from the /view/<id> page.
+    Returns None if the torrent doesn't exist anymore.
+    """
+    url = urlparse(FEED_URL)
+    base_url = f"{url.scheme}://{url.netloc}"
+    backfill_limiter.acquire('nyaa')
+    response = http_get(f"{base_url}/view/{id}", timeout=FEED_REQUEST_TIMEOUT)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    page = response.text
+    title = VIEW_TITLE_PATTERN.search(page)
+    infohash = VIEW_INFOHASH_PATTERN.search(page)
+    if not title or not infohash:
+        raise ValueError(f"Unexpected view page for {id}")
+    categories = VIEW_CATEGORY_PATTERN.findall(page)
+    timestamp = VIEW_TIMESTAMP_PATTERN.search(page)
+    size = VIEW_SIZE_PATTERN.search(page)
+    return {
+        'title': html.unescape(title.group(1)),
+        'link': f"{base_url}/download/{id}.torrent",
+        'guid': f"{base_url}/view/{id}",
+        'published': formatdate(int(timestamp.group(1))) if timestamp else formatdate(),
+        'nyaa_infohash': infohash.group(1).lower(),
+        'nyaa_categoryid': categories[-1][0] if categories else '',
+        'nyaa_category': " - ".join(html.unescape(name.strip()) for _, name in categories),
+        'nyaa_size': size.group(1).strip() if size else ''
+    }
+
+def backfill_entry(id):
     try:
-        try:
-            log("Fetching latest feed item...")
-            response = requests.get(FEED_URL, timeout=FEED_REQUEST_TIMEOUT)
-            log("Feed fetched.")
-            try:
-                log("Validating XML...")
-                root = ET.fromstring(response.content)
-                log("Validated.")
-                log("Parsing items...")
-                item = root.find('.//item')
-                entry = {
-                    'title': item.find('title').text,
-                    'link': item.find('link').text,
-                    'guid': item.find('guid').text,
-                    'published': item.find('pubDate').text,
-                    'nyaa_infohash': item.find('{https://nyaa.si/xmlns/nyaa}infoHash').text,
-                    'nyaa_categoryid': item.find('{https://nyaa.si/xmlns/nyaa}categoryId').text,
-                    'nyaa_category': item.find('{https://nyaa.si/xmlns/nyaa}category').text,
-                    'nyaa_size': item.find('{https://nyaa.si/xmlns/nyaa}size').text
-                }
-                log("Parsed.")
-                last_id = urlparse(entry['guid']).path.split('/')[-1]
-            except ET.ParseError as pe:
-                error_message = "XML Parse Error for latest entry: Incomplete or malformed XML."
-                log(error_message)
-                safe_send_message(chat_id=ERROR_REPORT_USER_ID, text=error_message)
-        except requests.RequestException as re:
-            error_message = str(re) + "\n\n" + traceback.format_exc()
-            log("Error fetching RSS: " + error_message)
-            safe_send_message(chat_id=ERROR_REPORT_USER_ID, text="Error fetching RSS for latest entry: " + error_message)
-        except Exception as e:
-            # Unknown error
-            error_message = str(e) + "\n\n" + traceback.format_exc()
-            log("Unknown Error fetching RSS for latest entry: " + error_message)
-            safe_send_message(chat_id=ERROR_REPORT_USER_ID, text="Error fetching RSS for latest entry: " + error_message)
+        entry = fetch_view_entry(id)
+        if entry is None:
+            log(f"Backfill: {id} not found, skipped.")
+            with backfill_lock:
+                backfill_missing_ids.add(id)
+            with state_lock:
+                failed_ids.discard(id)
+        else:
+            entry['destinations'] = get_default_destinations(entry)
+            entry['seen_at'] = time.time()
+            entry_queue.put([entry])
+            with state_lock:
+                failed_ids.discard(id)
+            log(f"Backfill: {id} queued.")
     except Exception as e:
-        # Unexpected error
-        try:
-            error_message = str(e) + "\n\n" + traceback.format_exc()
-            log("Error: " + error_message)
-        except Exception as ei:
-            log("Unknown internal error while fetching RSS.")
-    return last_id
+        # Retried when the gap is detected again on next fetch
+        log(f"Backfill: error fetching {id}: {e}")
+        with state_lock:
+            failed_ids.add(id)
+        reset_feed_cache()
+    finally:
+        with backfill_lock:
+            backfill_ids.discard(id)
+        # Newer entries can be sent now that this one is queued
+        entry_queue.release(int(id))
+        update_backlog_metrics()
+
+def schedule_backfill(entries, stop_at_id):
+    """
+    Called when the feed window didn't reach stop_at_id: the ids between stop_at_id
+    and the oldest entry of the window may have been missed. Only valid for a feed
+    listing every upload, as filtered feeds have gaps by design.
+    """
+    if not BACKFILL_ENABLED or not stop_at_id or not entries:
+        return 0
+    oldest_id = min(int(get_entry_id(entry)) for entry in entries)
+    # Only the newest BACKFILL_MAX_ITEMS ids are looked up, however old stop_at_id is
+    first_id = max(stop_at_id + 1, oldest_id - BACKFILL_MAX_ITEMS)
+    if first_id > stop_at_id + 1:
+        message_text = f"Feed gap of up to {oldest_id - stop_at_id - 1} items ({stop_at_id + 1} - {oldest_id - 1}). Only the newest {BACKFILL_MAX_ITEMS} will be backfilled."
+        log(message_text)
+        safe_send_message(chat_id=ERROR_REPORT_USER_ID, text=message_text)
+        with state_lock:
+            failed_ids.difference_update([id for id in failed_ids if stop_at_id < int(id) < first_id])
+    with backfill_lock:
+        missing = [str(id) for id in range(first_id, oldest_id)
+                   if str(id) not in backfill_ids and str(id) not in backfill_missing_ids]
+    missing = [id for id in missing if id not in processed_store and id not in entry_queue]
+    if not missing:
+        return 0
+    log(f"Feed gap detected. Backfilling {len(missing)} items from {missing[0]} to {missing[-1]}...")
+    with backfill_lock:
+        backfill_ids.update(missing)
+    for id in missing:
+        # Entries newer than a missed id wait for its backfill, to be sent in id order
+        entry_queue.hold(int(id))
+        backfill_executor.submit(backfill_entry, id)
+    update_backlog_metrics()
+    return len(missing)
 
-def fetch_rss_feed():
-    global rss_entries
+def fetch_rss_feed(feed):
     local_entries = []
     try:
         try:
-            log("Fetching feed...")
-            response = requests.get(FEED_URL, timeout=FEED_REQUEST_TIMEOUT)
-            log("Feed fetched.")
+            debug("Fetching feed %s...", feed.url)
+            headers = {}
+            if feed.etag:
+                headers['If-None-Match'] = feed.etag
+            if feed.last_modified:
+                headers['If-Modified-Since'] = feed.last_modified
+            with timed('feed_fetch'):
+                response = http_get(feed.url, timeout=FEED_REQUEST_TIMEOUT, headers=headers)
+            record_first('fetch')
+            if response.status_code == 304:
+                debug("Feed not modified.")
+                feed.on_poll_success()
+                return
+            response.raise_for_status()
+            metric_inc('http_bytes_received', len(response.content))
+            debug("Feed fetched.")
+            content_hash = hashlib.sha1(response.content).hexdigest()
+            if content_hash == feed.hash:
+                debug("Feed unchanged.")
+                feed.on_poll_success()
+                return
             try:
-                log("Validating XML...")
-                root = ET.fromstring(response.content)
-                log("Validated.")
-                log("Parsing items...")
-                for item in root.findall('.//item'):
-                    local_entries.append({
-                        'title': item.find('title').text,
-                        'link': item.find('link').text,
-                        'guid': item.find('guid').text,
-                        'published': item.find('pubDate').text,
-                        'nyaa_infohash': item.find('{https://nyaa.si/xmlns/nyaa}infoHash').text,
-                        'nyaa_categoryid': item.find('{https://nyaa.si/xmlns/nyaa}categoryId').text,
-                        'nyaa_category': item.find('{https://nyaa.si/xmlns/nyaa}category').text,
-                        'nyaa_size': item.find('{https://nyaa.si/xmlns/nyaa}size').text
-                    })
-                log("Parsed. Found " + str(len(local_entries)) + " items.")
-
-                rss_entries.extend(reversed(local_entries))
-
-                log("Feed parsed. Waiting " + str(CHECK_INTERVAL) + " seconds for next parsing.")
+                if not state_restored.is_set():
+                    debug("Waiting for the processed ids...")
+                    state_restored.wait()
+                debug("Parsing items...")
+                stop_at_id = get_stop_at_id(feed)
+                with timed('feed_parse'):
+                    local_entries, stopped = parse_feed_items(response.content, stop_at_id)
+                debug("Parsed. Found %d new items.", len(local_entries))
+                if not stopped and feed.backfill:
+                    schedule_backfill(local_entries, stop_at_id)
+                if not stopped:
+                    feed.window_size = max(feed.window_size, len(local_entries))
+                    if local_entries:
+                        feed.oldest_id = int(get_entry_id(local_entries[-1]))
+                # Items parsed again below the last id (failed ids, cache reset) are not new arrivals
+                new_entries = [entry for entry in local_entries if int(get_entry_id(entry)) > feed.last_id]
+                window_full = feed.last_id > 0 and len(new_entries) >= feed.window_size * POLL_FULL_WINDOW_RATIO
+                missed = 0
+                if feed.backfill and not stopped and feed.last_id > 0 and new_entries:
+                    # Ids of the unfiltered feed are consecutive, the gap tells how many items scrolled away
+                    missed = max(int(get_entry_id(new_entries[0])) - feed.last_id - len(new_entries), 0)
+
+                seen_at = time.time()
+                for entry in local_entries:
+                    entry['destinations'] = feed.route(entry)
+                    entry['seen_at'] = seen_at
+                added, overflowed = entry_queue.put(local_entries)
+                if added:
+                    log(f"Queued {added} new items from {feed.name}. {len(entry_queue)} items waiting.")
+                if overflowed:
+                    log(f"Queue full, {overflowed} items wait in the overflow.")
+                feed.etag = response.headers.get('ETag')
+                feed.last_modified = response.headers.get('Last-Modified')
+                feed.hash = content_hash
+                if local_entries:
+                    feed.last_id = max(feed.last_id, int(get_entry_id(local_entries[0])))
+                update_backlog_metrics()
+                feed.on_poll_success(new_entries, window_full, missed)
+
+                opened, served = update_http_stats()
+                debug("HTTP connections: %d opened, %d requests served.", opened, served)
+                if window_full:
+                    log(f"Window of {feed.name} almost full, polling faster.")
 
             except ET.ParseError as pe:
                 error_message = "XML Parse Error: Incomplete or malformed XML."
                 log(error_message)
                 safe_send_message(chat_id=ERROR_REPORT_USER_ID, text=error_message)
+                feed.on_poll_error()
         except requests.RequestException as re:
             error_message = str(re) + "\n\n" + traceback.format_exc()
-            log("Error fetching RSS: " + error_message)
-            safe_send_message(chat_id=ERROR_REPORT_USER_ID, text="Error fetching RSS: " + error_message)
+            log(f"Error fetching RSS {feed.url}: " + error_message)
+            safe_send_message(chat_id=ERROR_REPORT_USER_ID, text=f"Error fetching RSS {feed.url}: " + error_message)
+            feed.on_poll_error(get_retry_after(re.response))
         except Exception as e:
             # Unknown error
+            feed.on_poll_error()
             error_message = str(e) + "\n\n" + traceback.format_exc()
-            log("Unknown Error fetching RSS: " + error_message)
-            safe_send_message(chat_id=ERROR_REPORT_USER_ID, text="Error fetching RSS: " + error_message)
+            log(f"Unknown Error fetching RSS {feed.url}: " + error_message)
+            safe_send_message(chat_id=ERROR_REPORT_USER_ID, text=f"Error fetching RSS {feed.url}: " + error_message)
     except Exception as e:
         # Unexpected error
         try:
@@ -323,9 +1969,16 @@ def fetch_rss_feed():
         except Exception as ei:
             log("Unknown internal error while fetching RSS.")
 
-def safe_fetch_rss_feed():
+def get_retry_after(response):
+    # Seconds asked by a 429 or 503 response, if any
+    try:
+        return float(response.headers['Retry-After'])
+    except Exception:
+        return None
+
+def safe_fetch_rss_feed(feed):
     try:
-        fetch_rss_feed()
+        fetch_rss_feed(feed)
     except Exception as e:
         try:
             error_message = str(e) + "\n\n" + traceback.format_exc()
@@ -339,173 +1992,450 @@ def safe_fetch_rss_feed():
             except Exception as ei:
                 log("Unknown error while running scheduled job.")
 
-last_new_item_timestamp = time.time()
-last_alert_sent = 0
-last_processed_id = 0
-
-def reset_alerts():
-    global last_new_item_timestamp, last_alert_sent
-    last_new_item_timestamp = time.time()
-    last_alert_sent = 0
-
-def send_alert_if_needed():
-    global last_new_item_timestamp, last_alert_sent, processed_ids
-    time_thresholds = [
-        # (20, "20 seconds"),
-        # (40, "40 seconds"),
-        # (60, "1 minute"),
-        (600, "10 minutes"),
-        (1200, "20 minutes"),
-        (1800, "30 minutes"),
-        (3600, "1 hour"),
-        (7200, "2 hours"),
-        (14400, "4 hours"),
-        (21600, "6 hours")
-    ]
-    current_time = time.time()
-    message_sent = False
-
-    for threshold, message in time_thresholds:
-        if current_time - last_new_item_timestamp > threshold and last_alert_sent < threshold:
-            # verify if new items are being added to the xml
-            last_xml_id =  fetch_latest_rss_entry()
-            if last_xml_id not in processed_ids and (int(last_xml_id) > (int(last_processed_id) + 10)): # 10 is a safe margin to avoid false positives
-                # something is wrong
-                last_alert_sent = threshold
-                message_text = f"Something wrong.\nNo new items in the last {message}. But the XML feed has new items.\nLast items in the processed_ids: {last_processed_id}\nLast item in the XML: {last_xml_id}"
-                safe_send_message(chat_id=ERROR_REPORT_USER_ID, text=message_text)
-                log(message_text)
-                message_sent = True
-                break  # Only send one message per check
+async def poll_feed(feed):
+    # Poll the feed in the poll threads, then sleep for its interval, adapted after every poll
+    loop = asyncio.get_running_loop()
+    while True:
+        await loop.run_in_executor(poll_executor, safe_fetch_rss_feed, feed)
+        metric_set(f"poll_interval[feed={feed.name}]", feed.interval)
+        debug("Next poll of %s in %s seconds (%.2f items/min).", feed.url, feed.interval, feed.arrival_rate() * 60)
+        await asyncio.sleep(feed.interval)
+
+class LagAlert:
+    """
+    Threshold alert with hysteresis. Raised when the value reaches the threshold, raised again
+    each time the value doubles and cleared only when it falls below half the threshold,
+    so a value hovering around the threshold doesn't flood the admin.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.alerted = 0
+
+    def check(self, value):
+        # Returns 'raised', 'cleared' or None
+        if not self.threshold:
+            return None
+        if value >= max(self.threshold, self.alerted * 2):
+            self.alerted = value
+            return 'raised'
+        if self.alerted and value < self.threshold / 2:
+            self.alerted = 0
+            return 'cleared'
+        return None
+
+
+lag_seconds_alert = LagAlert(LAG_ALERT_SECONDS)
+lag_items_alert = LagAlert(LAG_ALERT_ITEMS)
+poll_alerts = {}
+
+def format_duration(seconds):
+    if seconds < 120:
+        return f"{int(seconds)} seconds"
+    if seconds < 7200:
+        return f"{int(seconds // 60)} minutes"
+    return f"{seconds / 3600:.1f} hours"
+
+def check_lag():
+    """
+    Compute the processing lag from the state published by the pollers and the queue,
+    without any request to nyaa: items waiting to be sent and how long ago the oldest
+    one was seen, plus the time since the last successful poll of each feed.
+    """
+    now = time.time()
+    queued, oldest_seen_at = entry_queue.backlog()
+    with backfill_lock:
+        backfill_pending = len(backfill_ids)
+    lag_items = queued + backfill_pending
+    lag_seconds = now - oldest_seen_at if oldest_seen_at else 0
+    newest_id = max([max_processed_id] + [feed.newest_id for feed in feeds])
+    metric_set('lag_items', lag_items)
+    metric_set('lag_seconds', round(lag_seconds, 1))
+    metric_set('newest_seen_id', newest_id)
+    metric_set('max_processed_id', max_processed_id)
+    debug("Lag: %d items, %.1f seconds.", lag_items, lag_seconds)
+
+    status = f"Items waiting: {lag_items}, oldest seen {format_duration(lag_seconds)} ago." if lag_items else "No items waiting."
+    status += f"\nNewest id in the feeds: {newest_id}\nLast processed id: {max_processed_id}"
+    alerts = []
+    state = lag_seconds_alert.check(lag_seconds)
+    if state == 'raised':
+        alerts.append(f"Something wrong.\nItems are waiting to be sent since {format_duration(lag_seconds)}.\n{status}")
+    elif state == 'cleared':
+        alerts.append(f"Processing lag back to normal.\n{status}")
+    state = lag_items_alert.check(lag_items)
+    if state == 'raised':
+        alerts.append(f"Something wrong.\n{lag_items} items are waiting to be sent.\n{status}")
+    elif state == 'cleared':
+        alerts.append(f"Processing backlog back to normal.\n{status}")
+
+    for feed in feeds:
+        poll_age = now - feed.polled_at
+        metric_set(f"poll_age_seconds[feed={feed.name}]", round(poll_age, 1))
+        # Feeds polled less often than the threshold are not late before two intervals
+        alert = poll_alerts.setdefault(feed.name, LagAlert(LAG_ALERT_SECONDS and max(LAG_ALERT_SECONDS, feed.interval * 2)))
+        state = alert.check(poll_age)
+        if state == 'raised':
+            alerts.append(f"Something wrong.\nNo successful poll of {feed.url} in the last {format_duration(poll_age)}.")
+        elif state == 'cleared':
+            alerts.append(f"Polling of {feed.url} back to normal.")
+
+    for message_text in alerts:
+        log(message_text, level=WARNING)
+        safe_send_message(chat_id=ERROR_REPORT_USER_ID, text=message_text)
+
+prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix='prefetch')
+
+# Set from any thread to stop the bot
+stop_event = threading.Event()
+# The only thread sending to Telegram, so entries are sent in id order
+send_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='send')
+
+def process_entries():
+    """
+    Process the ready entries until the queue has none left. Runs in the send thread,
+    started by the runtime each time the queue signals new entries.
+    """
+    # Entries taken from the queue with their torrent download, in id order
+    pending = collections.deque()
+    # Albums are sent by the main bot only
+    batch_size = ALBUM_MAX_SIZE if ALBUM_ENABLED and not shards else 1
+    prefetch_depth = max(PREFETCH_DEPTH, batch_size)
+    batch_deadline = 0
+    processed = False
+    while not stop_event.is_set():
+        # Keep up to PREFETCH_DEPTH downloads running ahead of the sender
+        while len(pending) < prefetch_depth:
+            if not pending:
+                timeout = 0
+            elif len(pending) < batch_size:
+                # Give the following entries of a burst ALBUM_WINDOW seconds to join the album
+                timeout = max(batch_deadline - time.time(), 0)
             else:
-                # normal behavior
-                last_alert_sent = threshold
-                log("No new items in the last " + message + " but no new items detected from the XML feed when checking.")
-                message_sent = False
+                timeout = 0
+            entry = entry_queue.get(timeout=timeout)
+            if entry is None:
                 break
+            if not pending:
+                batch_deadline = time.time() + ALBUM_WINDOW
+            download = None if is_uploaded(entry) else prefetch_executor.submit(download_torrent, entry)
+            pending.append((entry, download))
+        if not pending:
+            break
+        processed = True
+        process_batch([pending.popleft() for _ in range(min(len(pending), batch_size))])
+        if queue_journal is not None and queue_journal.records >= QUEUE_JOURNAL_COMPACT_SIZE:
+            debug("Compacting queue journal...")
+            compact_queue_journal()
+            debug("Compacted. %d records left.", queue_journal.records)
+    # Entries taken before a stop are released unprocessed: they are still in the journal and the feed
+    for entry, download in pending:
+        entry_queue.task_done(entry)
+    processed_store.flush()
+    if processed and not stop_event.is_set():
+        log("No more entries to process. Waiting for new entries...")
 
-    return message_sent
+def process_batch(batch):
+    # Send the albums of the batch in id order, then each entry sends what is left
+    albums = {}
+    if len(batch) > 1:
+        try:
+            albums = plan_albums(batch)
+        except Exception as e:
+            log(f"Error planning albums, sending one by one: {e}")
+    for entry, download in batch:
+        dispatched = False
+        try:
+            for destination, items in albums.get(get_entry_id(entry), ()):
+                send_album(destination, items)
+            dispatched = process_entry(entry, download)
+        finally:
+            # Entries dispatched to the shards stay in-flight until every shard is done
+            if not dispatched:
+                entry_queue.task_done(entry)
+    update_backlog_metrics()
 
-def process_entries():
-    global rss_entries
-    to_process = False
-    while True:
-        if rss_entries:
-            to_process = True
-            entry = rss_entries.pop(0)
-            process_entry(entry)  # Assuming this function is defined elsewhere
-        else:
-            if to_process:
-                log("No more entries to process. Waiting for new entries...")
-                to_process = False
-            send_alert_if_needed()
-            time.sleep(1)  # Sleep for a short time if there are no entries to process
-
-def process_entry(entry):
-    global last_processed_id, processed_ids
+def plan_albums(batch):
+    """
+    Group the entries of a batch going to the same destination in albums of up to ALBUM_MAX_SIZE documents.
+    Only consecutive entries are grouped so every channel keeps the id order: an entry that can't
+    be in an album (caption too long, torrent file missing) ends the album of its destinations.
+    Returns the albums as lists of (destination, items) by id of their first entry.
+    """
+    albums = collections.defaultdict(list)
+    runs = {}
+
+    def close(destination):
+        run = runs.pop(destination, None)
+        if run is not None and len(run) > 1:
+            albums[run[0]['id']].append((destination, run))
+
+    for entry, download in batch:
+        id = get_entry_id(entry)
+        if id in processed_store and not entry.get('destinations'):
+            continue
+        message, message_part1, _ = format_message(entry)
+        item = None
+        if message_part1 is None:
+            file_id = get_cached_file_id(id, entry['nyaa_infohash'])
+            file_path = None
+            if file_id is None and download is not None:
+                try:
+                    file_path = download.result()[0]
+                except Exception:
+                    pass
+            if file_id is not None or file_path is not None:
+                item = {'id': id, 'infohash': entry['nyaa_infohash'], 'caption': message, 'file_id': file_id, 'file_path': file_path}
+        for destination in get_undelivered_destinations(entry):
+            if item is None:
+                close(destination)
+                continue
+            runs.setdefault(destination, []).append(item)
+            if len(runs[destination]) == ALBUM_MAX_SIZE:
+                close(destination)
+    for destination in list(runs):
+        close(destination)
+    return albums
+
+def send_album(destination, items):
+    # Send the items as one album. On failure process_entry() sends them one by one.
+    debug("Sending album of %d torrents to %s...", len(items), destination)
     try:
+        with contextlib.ExitStack() as stack:
+            media = []
+            for item in items:
+                document = item['file_id'] or stack.enter_context(open(item['file_path'], 'rb'))
+                media.append(InputMediaDocument(document, caption=item['caption'], parse_mode='HTML'))
+            messages = safe_send_media_group(chat_id=destination, media=media)
+        for item, message in zip(items, messages):
+            # Upload once: the albums of the other destinations use the returned file_ids
+            if item['file_id'] is None and message.document is not None:
+                metric_inc('telegram_bytes_uploaded', os.path.getsize(item['file_path']))
+                item['file_id'] = message.document.file_id
+                cache_file_id(item['id'], item['infohash'], item['file_id'])
+            mark_delivered(item['id'], destination)
+        metric_inc('album_sends')
+        metric_inc('album_documents', len(items))
+        metric_inc('telegram_requests_saved', len(items) - 1)
+        log(f"Sent album to {destination}: {len(items)} torrents in 1 request instead of {len(items)}. "
+            f"{metrics['telegram_requests_saved']} requests saved so far.")
+    except Exception as e:
+        log(f"Error sending album to {destination}: {e}. Sending one by one...", level=WARNING)
+
+def download_torrent(entry):
+    """
+    Download and save the torrent file of an entry. Runs in the prefetch threads.
+    Returns the saved file path (None if saving failed) and the original file name.
+    """
+    id = get_entry_id(entry)
+    infohash = entry['nyaa_infohash']
+    stored_path = torrent_storage.find(id, infohash)
+    if stored_path is not None:
+        # Already downloaded, for this id or another one with the same infohash
+        metric_inc('torrent_downloads_skipped')
+        debug("Torrent file %s already stored: %s", id, stored_path)
+        return stored_path, os.path.basename(stored_path).split('-', 1)[-1]
+    debug("Downloading torrent file %s...", id)
+    # Stream the file to disk in chunks, the body is never held in memory
+    started = time.perf_counter()
+    with http_get(entry['link'], timeout=TORRENT_FILE_REQUEST_TIMEOUT, stream=True) as response:
+        # Only the time waiting for the network is timed here, saving is timed as disk_write
+        chunks = CountedChunks(response.iter_content(chunk_size=65536), time.perf_counter() - started)
+        response.raise_for_status()
+        # Extract the filename from the Content-Disposition header and unquote
+        suggested_filename = unquote(response.headers['Content-Disposition'].split('filename*=UTF-8\'\'')[-1])
+        # Add [id] and [hash] in the filename before the .torrent extension
+        file_name, file_ext = os.path.splitext(suggested_filename)
+        sanitized_file_name = sanitize_filename(file_name)
         try:
-            # Parse ID from GUID URL
-            id = urlparse(entry['guid']).path.split('/')[-1]
-            title = entry['title'].replace("&", "&amp;").replace("<","&lt;").replace(">", "&gt;") #avoid unsupported start tag error when send message with <...> titles
+            if TORRENT_MAX_SIZE and int(response.headers.get('Content-Length') or 0) > TORRENT_MAX_SIZE:
+                raise TorrentTooLarge(f"Torrent file {id} is larger than {TORRENT_MAX_SIZE} bytes.")
+            file_path = torrent_storage.save(id, infohash, sanitized_file_name, file_ext, chunks, TORRENT_MAX_SIZE)
+            debug("Saved %s.", id)
+        except TorrentTooLarge as e:
+            # Sent as a message only
+            file_path = None
+            metric_inc('torrent_too_large')
+            log(str(e) + " Sending the message only.", level=WARNING)
+        except ValueError as e:
+            # Not a valid torrent, downloading it again wouldn't help
+            file_path = None
+            metric_inc('torrent_invalid')
+            log(f"Torrent file {id} is invalid: {e}. Sending the message only.", level=WARNING)
+        except OSError as e:
+            file_path = None
+            log("Error saving file: " + str(e), level=ERROR)
+        finally:
+            metric_observe("stage_seconds[stage=torrent_download]", chunks.elapsed)
+    return file_path, f"{file_name}{file_ext}"
 
-            # If we haven't processed this entry yet
-            if id not in processed_ids:
-                log(f"Processing entry: {id} | {title}")
-                # Form the magnet link with URL encoding
-                magnet_link = f"magnet:?xt=urn:btih:{entry['nyaa_infohash']}&dn={quote(title)}&tr=http%3A%2F%2Fnyaa.tracker.wf%3A7777%2Fannounce&tr=udp%3A%2F%2Fopen.stealth.si%3A80%2Fannounce&tr=udp%3A%2F%2Ftracker.opentrackr.org%3A1337%2Fannounce&tr=udp%3A%2F%2Fexodus.desync.com%3A6969%2Fannounce&tr=udp%3A%2F%2Ftracker.torrent.eu.org%3A451%2Fannounce"
-                view_link = f"<a href='{entry['guid']}'>View</a>"
-                download_link = f"<a href='{entry['link']}'>Download</a>"
-                published_datetime = entry['published'].replace(" -0000", "")
-                
-                # Replace spaces and - in category with underscores and prepend with #
-                category = "#" + entry['nyaa_category'].replace(" ", "_").replace("-", "_")
-
-                # Form the message in HTML
-                message = f"<b>{title}</b>\n<b>{entry['nyaa_size']}</b> - {category}\n\n{download_link} - {view_link}\n\nID: {id}\nHash: <code>{entry['nyaa_infohash']}</code>\n\n<code>{magnet_link}</code>\n\nPublished: {published_datetime}"
-                if len(message) >= 1024:
-                    message_part1 = f"<b>{title}</b>\n<b>{entry['nyaa_size']}</b> - {category}\n\n{download_link} - {view_link}\n\nID: {id}\nHash: <code>{entry['nyaa_infohash']}</code>"
-                    message_part2 = f"<code>{magnet_link}</code>\n\nPublished: {published_datetime}"
-                
-                log("Downloading torrent file...")
-                # Download the file
-                response = requests.get(entry['link'], stream=True, timeout=TORRENT_FILE_REQUEST_TIMEOUT)
-                log("Downloaded. Saving...")
-                # Extract the filename from the Content-Disposition header and unquote
-                suggested_filename = unquote(response.headers['Content-Disposition'].split('filename*=UTF-8\'\'')[-1])
-                # Add [id] and [hash] in the filename before the .torrent extension
-                file_name, file_ext = os.path.splitext(suggested_filename)
-                sanitized_file_name = sanitize_filename(file_name)
-                #file_path = os.path.join(DOWNLOAD_PATH, f"{file_name}{file_ext}")#[{id}][{entry['nyaa_infohash']}]{file_ext}")
-                file_path = generate_unique_filename(sanitized_file_name, file_ext, id)
+class CountedChunks:
+    # Iterate over the chunks of a response, counting the bytes and the seconds spent receiving them
+
+    def __init__(self, chunks, elapsed=0):
+        self.chunks = iter(chunks)
+        self.elapsed = elapsed
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            chunk = next(self.chunks)
+        finally:
+            self.elapsed += time.perf_counter() - started
+        metric_inc('http_bytes_received', len(chunk))
+        return chunk
 
+def format_message(entry):
+    """
+    Form the HTML message of an entry. Messages of 1024 characters or more don't fit
+    in a caption and are split in two parts, otherwise the parts are None.
+    """
+    id = get_entry_id(entry)
+    title = entry['title'].replace("&", "&amp;").replace("<","&lt;").replace(">", "&gt;") #avoid unsupported start tag error when send message with <...> titles
+    # Form the magnet link with URL encoding
+    magnet_link = f"magnet:?xt=urn:btih:{entry['nyaa_infohash']}&dn={quote(title)}&tr=http%3A%2F%2Fnyaa.tracker.wf%3A7777%2Fannounce&tr=udp%3A%2F%2Fopen.stealth.si%3A80%2Fannounce&tr=udp%3A%2F%2Ftracker.opentrackr.org%3A1337%2Fannounce&tr=udp%3A%2F%2Fexodus.desync.com%3A6969%2Fannounce&tr=udp%3A%2F%2Ftracker.torrent.eu.org%3A451%2Fannounce"
+    view_link = f"<a href='{entry['guid']}'>View</a>"
+    download_link = f"<a href='{entry['link']}'>Download</a>"
+    published_datetime = entry['published'].replace(" -0000", "")
+
+    # Replace spaces and - in category with underscores and prepend with #
+    category = "#" + entry['nyaa_category'].replace(" ", "_").replace("-", "_")
+
+    # Form the message in HTML
+    message = f"<b>{title}</b>\n<b>{entry['nyaa_size']}</b> - {category}\n\n{download_link} - {view_link}\n\nID: {id}\nHash: <code>{entry['nyaa_infohash']}</code>\n\n<code>{magnet_link}</code>\n\nPublished: {published_datetime}"
+    message_part1 = None
+    message_part2 = None
+    if len(message) >= 1024:
+        message_part1 = f"<b>{title}</b>\n<b>{entry['nyaa_size']}</b> - {category}\n\n{download_link} - {view_link}\n\nID: {id}\nHash: <code>{entry['nyaa_infohash']}</code>"
+        message_part2 = f"<code>{magnet_link}</code>\n\nPublished: {published_datetime}"
+    return message, message_part1, message_part2
+
+def send_entry(id, infohash, messages, file_path, destinations, delivered):
+    """
+    Send the message of an entry to each destination, with the torrent file if downloaded or
+    already uploaded. The file is uploaded once, the returned file_id is sent to the other
+    destinations. delivered(destination) is called after each destination.
+    """
+    message, message_part1, message_part2 = messages
+    file_id = get_cached_file_id(id, infohash)
+    debug("Sending message...")
+    if file_path is not None or file_id is not None:
+        # Upload the file once, then send the returned file_id to the other destinations
+        debug("Sending file %s%s...", file_path, "" if file_id is None else " with cached file_id")
+        upload = None
+        for destination in destinations:
+            debug("Sending to %s...", destination)
+            caption = message_part1 if len(message) >= 1024 else message
+            sent = None
+            if file_id is not None:
                 try:
-                    with open(file_path, 'wb') as f:
-                        f.write(response.content)
-                        send_file = True
-                        log("Saved.")
-                except Exception as e:
-                    send_file = False  
-                    log("Error saving file: " + str(e))
-
-                send_to = [TELEGRAM_CHANNEL_ID]
-                
-                # Send the message with the file to each corresponding channel
-                for mapping in category_channel_mappings:
-                    if mapping.category == entry['nyaa_categoryid'] and mapping.enabled:
-                        send_to.append(mapping.channel)                  
-
-                log("Sending message...")
-                if send_file:
-                    # Send the message with the file to global channel
-                    log(f"Sending file {file_path} ...")
+                    sent = safe_send_document(chat_id=destination, document=file_id, caption=caption, parse_mode='HTML')
+                except BadRequest as e:
+                    log(f"Cached file_id refused ({e}). Uploading file...", level=WARNING)
+                    uncache_file_id(id, infohash)
+                    file_id = None
+            if sent is None:
+                if file_path is None:
+                    raise Exception(f"Cached file_id of {id} refused and torrent file not downloaded.")
+                if upload is None:
+                    # Read the file once, for all the destinations and retries
                     with open(file_path, 'rb') as f:
-                        for destination in send_to:
-                            log(f"Sending to {destination}...")
-                            f.seek(0)  # Reset the file pointer to the beginning of the file
-                            if len(message) >= 1024:
-                                safe_send_document(chat_id=destination, document=InputFile(f), caption=message_part1, parse_mode='HTML')
-                                log("Sent first part. Sending second part...")
-                                safe_send_message(chat_id=destination, text=message_part2, parse_mode='HTML')
-                                log("Sent second part.")
-                            else:
-                                safe_send_document(chat_id=destination, document=InputFile(f), caption=message, parse_mode='HTML')
-                                log("Done.")
-                            #time.sleep(3) #slow processing to avoid flood error # disabled -> already added delay in safe_send_* functions
+                        upload = InputFile(f)
+                sent = safe_send_document(chat_id=destination, document=upload, caption=caption, parse_mode='HTML')
+                if sent is not None and sent.document is not None:
+                    metric_inc('telegram_bytes_uploaded', os.path.getsize(file_path))
+                    file_id = sent.document.file_id
+                    cache_file_id(id, infohash, file_id)
+            if len(message) >= 1024:
+                debug("Sent first part. Sending second part...")
+                safe_send_message(chat_id=destination, text=message_part2, parse_mode='HTML')
+                debug("Sent second part.")
+            else:
+                debug("Done.")
+            delivered(destination)
+    else:
+        debug("Sending message only...")
+        for destination in destinations:
+            debug("Sending to %s...", destination)
+            if len(message) >= 1024:
+                safe_send_message(chat_id=destination, text=message_part1, parse_mode='HTML')
+                debug("Sent first part. Sending second part...")
+                safe_send_message(chat_id=destination, text=message_part2, parse_mode='HTML')
+                debug("Sent second part.")
+            else:
+                safe_send_message(chat_id=destination, text=message, parse_mode='HTML')
+                debug("Done.")
+            delivered(destination)
+
+def complete_entry(id, saved_name, infohash):
+    global max_processed_id
+    processed_store.add(id, saved_name, infohash)
+    with state_lock:
+        max_processed_id = max(max_processed_id, int(id))
+        failed_ids.discard(id)
+    metric_inc('entries_processed')
+
+def process_entry(entry, download=None):
+    # Returns True if the entry was dispatched to the shards, they complete it
+    try:
+        try:
+            id = get_entry_id(entry)
+            title = entry['title'].replace("&", "&amp;").replace("<","&lt;").replace(">", "&gt;") #avoid unsupported start tag error when send message with <...> titles
+
+            # If we haven't processed this entry yet. Processed entries are queued again only for
+            # the destinations of other feeds not delivered yet.
+            if id not in processed_store or entry.get('destinations'):
+                log(f"Processing entry: {id} | {title}")
+                message, message_part1, message_part2 = format_message(entry)
+
+                infohash = entry['nyaa_infohash']
+                if is_uploaded(entry):
+                    # Already uploaded for another feed, no need to download it again
+                    file_path, saved_name = None, None
+                elif download is None:
+                    file_path, saved_name = download_torrent(entry)
                 else:
-                    log("Sending message only...")
-                    for destination in send_to:
-                        log(f"Sending to {destination}...")
-                        if len(message) >= 1024:
-                            safe_send_message(chat_id=TELEGRAM_CHANNEL_ID, text=message_part1, parse_mode='HTML')
-                            log("Sent first part. Sending second part...")
-                            safe_send_message(chat_id=TELEGRAM_CHANNEL_ID, text=message_part2, parse_mode='HTML')
-                            log("Sent second part.")
-                        else:
-                            safe_send_message(chat_id=TELEGRAM_CHANNEL_ID, text=message, parse_mode='HTML')
-                            log("Done.")
-                        #time.sleep(3) #slow processing to avoid flood error # disabled -> already added delay in safe_send_* functions
-                    
+                    debug("Waiting for torrent file...")
+                    try:
+                        file_path, saved_name = download.result()
+                    except Exception as e:
+                        # A failed prefetch is retried once here so the entry keeps its place in order
+                        log(f"Prefetch of torrent file failed: {e}. Retrying...", level=WARNING)
+                        file_path, saved_name = download_torrent(entry)
 
+                # Send the message with the file to each destination of the entry,
+                # skipping the ones already delivered before a restart, a failure or in an album
+                send_to = get_undelivered_destinations(entry)
+                if shards and dispatch_to_shards(entry, (message, message_part1, message_part2), file_path, saved_name, send_to):
+                    debug("Dispatched to shards.")
+                    return True
+                send_entry(id, infohash, (message, message_part1, message_part2), file_path,
+                           iter_destinations(id, send_to), lambda destination: mark_delivered(id, destination))
 
                 # Mark the entry as processed - Attach the torrent name to ids
-                processed_ids.add(id)
-                last_processed_id = id
-                log("Saving entry to processed_ids file.")
-                with open(processed_file_path, 'a', encoding="utf-8") as file:
-                    file.write(f"{id}|{file_name}{file_ext}\n")
-                log("Saved.")
-
-                reset_alerts()
-                log(f"Processed.")
+                debug("Saving entry to processed ids.")
+                complete_entry(id, saved_name, infohash)
+                debug("Saved.")
+
+                debug("Processed.")
             # else:
             #     log(f"Entry already processed: {id} | {title}")
+        except Stopping:
+            # Resumed from the journal on restart
+            log(f"Stopped while sending entry {id}.")
         except Exception as e:
             error_message = str(e) + "\n\n" + traceback.format_exc()
-            log(f"Error processing entry: {id} | {title} \nError:" + error_message)
+            log(f"Error processing entry: {id} | {title} \nError:" + error_message, level=ERROR)
+            # Parse the entry again on next fetch to retry it
+            with state_lock:
+                failed_ids.add(id)
+            reset_feed_cache()
             safe_send_message(chat_id=ERROR_REPORT_USER_ID, text="Error processing entry: " + error_message)
             log("Waiting 60 seconds to retry.")
-            time.sleep(60)
+            stop_event.wait(60)
     except Exception as e:
         # Unexpected error
         try:
@@ -513,42 +2443,372 @@ def process_entry(entry):
             log("Error: " + error_message)
         except Exception as ei:
             log("Unknown internal error.")
-        time.sleep(120)
+        stop_event.wait(120)
 
     
 
-# safe_send_message(chat_id=ERROR_REPORT_USER_ID, text="Max retry attempts reached.\n\nBye Bye!")
-# log("Max retry attempts reached.\n\nBye Bye!")
-
-# Start processing thread
-log("Starting processing thread...")
-thread = threading.Thread(target=process_entries)
-thread.daemon = True
-thread.start()
-log("Started.")
-
-# First Run and then Schedule the fetching task
-log("First run of fetch_rss_feed...")
-safe_fetch_rss_feed()
-log("First run done. Scheduling task.")
-schedule.every(CHECK_INTERVAL).seconds.do(safe_fetch_rss_feed)
-log("Scheduled.")
-
-# Start scheduled tasks
-while True:
+class Shard:
+    """
+    A worker process sending to its share of the destinations with its own bot token,
+    rate limiter and file_id cache. Jobs are queued in id order, so each destination keeps
+    the id order. Jobs not acknowledged yet are queued again if the process is restarted.
+    """
+
+    def __init__(self, index, token, channels):
+        self.index = index
+        self.token = token
+        self.name = f"shard{index}"
+        # Channels pinned to this shard
+        self.channels = channels
+        # Jobs sent and not done yet by id, without the destinations already delivered
+        self.outstanding = {}
+        self.jobs = None
+        self.process = None
+        self.started_at = 0
+
+    def file_id_cache(self):
+        # A file_id can be used only by the bot that uploaded the file, so each bot has its own cache
+        if not FILE_ID_CACHE:
+            return ''
+        root, ext = os.path.splitext(FILE_ID_CACHE)
+        return f"{root}.{self.token.split(':')[0]}{ext}"
+
+    def start(self):
+        with shards_lock:
+            self.jobs = shard_context.Queue()
+            self.process = shard_context.Process(target=run_shard, name=self.name, daemon=True,
+                                                 args=(self.index, self.token, self.file_id_cache(), self.jobs, shard_results))
+            self.process.start()
+            self.started_at = time.time()
+            for job in self.outstanding.values():
+                self.jobs.put(job)
+
+    def submit(self, job):
+        with shards_lock:
+            self.outstanding[job['id']] = job
+            self.jobs.put(job)
+        metric_inc(f"shard_jobs[shard={self.name}]")
+
+    def stop(self):
+        # The process sends the jobs already queued, then exits
+        self.jobs.put(None)
+
+
+SHARD_RESTART_DELAY = 30
+
+# Started by setup() when SHARD_BOT_TOKENS is set
+shards = []
+shard_channels = {}
+shard_entries = {}
+shards_lock = threading.Lock()
+# Spawned processes don't inherit the threads and connections of the main process
+shard_context = multiprocessing.get_context('spawn')
+shard_results = None
+shard_collector = None
+
+def start_shards():
+    # The shards in the "token|channel1;channel2" format separated by commas, channels are optional
+    global shard_results, shard_collector
+    log("Starting shards...")
+    shard_results = shard_context.Queue()
+    for shard_str in SHARD_BOT_TOKENS.split(','):
+        if not shard_str:
+            continue
+        token, _, channels = shard_str.partition('|')
+        shard = Shard(len(shards), token.strip(), [channel for channel in channels.split(';') if channel])
+        shards.append(shard)
+        for channel in shard.channels:
+            shard_channels[channel] = shard
+    for shard in shards:
+        shard.start()
+    # Log where the known channels are sent from, the others are assigned on first use
+    channels = [TELEGRAM_CHANNEL_ID] + [mapping.channel for mapping in category_channel_mappings]
+    for feed in feeds:
+        channels += feed.destinations or []
+    if routing_rules is not None:
+        channels += [rule.channel for rule in routing_rules.rules]
+    for shard in shards:
+        assigned = sorted(set(str(channel) for channel in channels if shard_for(channel) is shard))
+        log(f"Started {shard.name} (bot {shard.token.split(':')[0]}) -> {', '.join(assigned) or 'no known channels'}")
+    shard_collector = threading.Thread(target=collect_shard_results, name='shard-collector', daemon=True)
+    shard_collector.start()
+    log("Started.")
+
+def stop_shards():
+    # Let the shards send their queued jobs, then record their last results
+    for shard in shards:
+        shard.stop()
+    for shard in shards:
+        shard.process.join(timeout=60)
+        if shard.process.is_alive():
+            log(f"{shard.name} didn't stop in time, terminating it.", level=WARNING)
+            shard.process.terminate()
+    shard_results.put(None)
+    shard_collector.join()
+
+def shard_for(destination):
+    # Pinned channels go to their shard, the others are spread by a stable hash
+    shard = shard_channels.get(str(destination))
+    if shard is None:
+        shard = shards[zlib.crc32(str(destination).encode()) % len(shards)]
+    return shard
+
+def dispatch_to_shards(entry, messages, file_path, saved_name, send_to):
+    """
+    Split the destinations of an entry by shard and queue a job to each shard.
+    The entry stays in-flight until every shard is done, then collect_shard_results()
+    marks it as processed. Returns False if there is nothing to send.
+    """
+    id = get_entry_id(entry)
+    jobs = {}
+    for destination in send_to:
+        shard = shard_for(destination)
+        jobs.setdefault(shard, {'id': id, 'infohash': entry['nyaa_infohash'], 'messages': messages, 'file_path': file_path,
+                                'destinations': []})['destinations'].append(destination)
+    if not jobs:
+        return False
+    with shards_lock:
+        shard_entries[id] = {'entry': entry, 'saved_name': saved_name, 'pending': set(shard.index for shard in jobs), 'errors': []}
+    for shard, job in jobs.items():
+        shard.submit(job)
+    return True
+
+def run_shard(index, token, file_id_cache, jobs, results):
+    """
+    Main function of a shard process: send the jobs with its own bot and file_id cache,
+    reporting each delivery and the end of each job to the main process.
+    """
+    global bot, FILE_ID_CACHE
+    # Stopped by the main process once the queued jobs are sent
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    bot = Bot(token=token, base_url=TELEGRAM_API_URL, request=Request(con_pool_size=HTTP_POOL_SIZE))
+    FILE_ID_CACHE = file_id_cache
+    if FILE_ID_CACHE:
+        load_file_id_cache()
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        id = job['id']
+        error = None
+        try:
+            send_entry(id, job['infohash'], job['messages'], job['file_path'], job['destinations'],
+                       lambda destination: results.put(('sent', index, id, destination)))
+        except Exception as e:
+            error = str(e) + "\n\n" + traceback.format_exc()
+            log(f"Error sending entry {id} from shard{index}: " + error, level=ERROR)
+        results.put(('done', index, id, error))
+
+def collect_shard_results():
+    # Runs in its own thread of the main process: records the shard results and restarts the dead shards
+    while True:
+        try:
+            result = shard_results.get(timeout=1)
+        except queue.Empty:
+            check_shards()
+            continue
+        if result is None:
+            return
+        try:
+            kind, index, id, value = result
+            shard = shards[index]
+            if kind == 'sent':
+                mark_delivered(id, value)
+                metric_inc(f"shard_deliveries[shard={shard.name}]")
+                with shards_lock:
+                    job = shard.outstanding.get(id)
+                    if job is not None and value in job['destinations']:
+                        job['destinations'].remove(value)
+                continue
+            with shards_lock:
+                shard.outstanding.pop(id, None)
+                state = shard_entries[id]
+                state['pending'].discard(index)
+                if value:
+                    state['errors'].append(value)
+                if state['pending']:
+                    continue
+                del shard_entries[id]
+            finish_sharded_entry(id, state)
+        except Exception as e:
+            log(f"Error handling shard result {result}: {e}", level=ERROR)
+
+def finish_sharded_entry(id, state):
+    entry = state['entry']
     try:
-        schedule.run_pending()
+        if state['errors']:
+            error_message = "\n\n".join(state['errors'])
+            log(f"Error processing entry: {id} \nError:" + error_message, level=ERROR)
+            # Parse the entry again on next fetch to retry the destinations not delivered
+            with state_lock:
+                failed_ids.add(id)
+            reset_feed_cache()
+            safe_send_message(chat_id=ERROR_REPORT_USER_ID, text="Error processing entry: " + error_message)
+        else:
+            complete_entry(id, state['saved_name'], entry['nyaa_infohash'])
+            debug("Processed %s.", id)
+    finally:
+        entry_queue.task_done(entry)
+        if not shard_entries:
+            processed_store.flush()
+        update_backlog_metrics()
+
+def check_shards():
+    with shards_lock:
+        metric_set('shard_outstanding', sum(len(shard.outstanding) for shard in shards))
+    if stop_event.is_set():
+        return
+    for shard in shards:
+        # A shard failing at start (like an invalid token) is restarted at most every SHARD_RESTART_DELAY seconds
+        if not shard.process.is_alive() and time.time() - shard.started_at >= SHARD_RESTART_DELAY:
+            message_text = f"{shard.name} stopped with exit code {shard.process.exitcode}. Restarting it with {len(shard.outstanding)} jobs to send."
+            log(message_text, level=ERROR)
+            metric_inc('shard_restarts')
+            shard.start()
+            safe_send_message(chat_id=ERROR_REPORT_USER_ID, text=message_text)
+
+def setup():
+    """
+    Initialize the bot, the folders, the processed store and the queue.
+    Nothing runs at import time, so the module can be used by tools and benchmarks.
+    """
+    global bot, processed_store, torrent_storage, started_at
+    started_at = time.time()
+    bot = Bot(token=TELEGRAM_BOT_TOKEN, base_url=TELEGRAM_API_URL, request=Request(con_pool_size=HTTP_POOL_SIZE))
+
+    start_message = "Nyaa RSS bot " + version + " released on " + released + " started."
+    log(start_message)
+    # Sent in the background, the retries don't delay the first fetch
+    threading.Thread(target=send_start_message, args=(start_message,), name='start-message', daemon=True).start()
+
+    # Create downloads folder if not exists
+    log("Creating downloads folder if not exists...")
+    if not os.path.exists(DOWNLOAD_PATH):
+        os.makedirs(DOWNLOAD_PATH)
+    torrent_storage = TorrentStorage(DOWNLOAD_PATH)
+    log("Done.")
+
+    processed_store = open_processed_store()
+    if FILE_ID_CACHE and not SHARD_BOT_TOKENS:
+        # With shards the file_ids are cached by each shard for its bot
+        file_ids_loaded.clear()
+        threading.Thread(target=load_file_id_cache, name='file-ids', daemon=True).start()
+    load_category_channel_mappings()
+    if ROUTING_RULES_FILE:
+        load_routing_rules()
+    load_feeds()
+    open_entry_queue()
+    threading.Thread(target=restore_state, name='restore', daemon=True).start()
+    if SHARD_BOT_TOKENS:
+        start_shards()
+    if RECORD_FILE:
+        open_response_recorder()
+    if METRICS_PORT:
+        start_metrics_server()
+    startup_seconds = time.time() - started_at
+    metric_set('startup_seconds', round(startup_seconds, 3))
+    log(f"Setup done in {startup_seconds:.2f} seconds.")
+
+def send_start_message(start_message):
+    try:
+        safe_send_message(chat_id=ERROR_REPORT_USER_ID, text=start_message)
     except Exception as e:
+        log(f"Error sending the start message: {e}", level=WARNING)
+
+# Time setup() was called, and the first events after it
+started_at = 0
+first_events = set()
+
+def record_first(event):
+    # Log and expose the time from the start to the first fetch and to the first post
+    if event in first_events or not started_at:
+        return
+    first_events.add(event)
+    seconds = time.time() - started_at
+    metric_set(f"time_to_first_{event}_seconds", round(seconds, 3))
+    log(f"First {event} {seconds:.2f} seconds after start.")
+
+def open_response_recorder():
+    global response_recorder
+    response_recorder = ResponseRecorder(RECORD_FILE)
+    log(f"Recording HTTP responses to {RECORD_FILE}.")
+
+async def process_queue(queue_ready):
+    # Wait for the queue listener, then process the entries in the send thread
+    loop = asyncio.get_running_loop()
+    while True:
+        await queue_ready.wait()
+        queue_ready.clear()
+        await loop.run_in_executor(send_executor, process_entries)
+
+async def run_periodically(interval, function):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        await loop.run_in_executor(None, function)
+
+def log_metrics_summary():
+    log(metrics_summary())
+
+async def run_async():
+    """
+    The bot runtime: one task per feed, the queue processing task and the periodic tasks.
+    Blocking work runs in the poll, prefetch and send threads. Setting stop_event, SIGINT or
+    SIGTERM cancel the tasks, then the threads finish their current work before closing.
+    """
+    loop = asyncio.get_running_loop()
+    queue_ready = asyncio.Event()
+    queue_ready.set()  # Entries resumed from the journal
+    entry_queue.listener = lambda: loop.call_soon_threadsafe(queue_ready.set)
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
         try:
-            error_message = str(e) + "\n\n" + traceback.format_exc()
-            log("Very unexpected error on handling scheduled job: " + error_message)
-            safe_send_message(chat_id=ERROR_REPORT_USER_ID, text="Very unexpected error on handling scheduled job: " + error_message)
-        except Exception as e:
-            # Unexpected error
-            try:
-                error_message = str(e) + "\n\n" + traceback.format_exc()
-                log("Error: " + error_message)
-            except Exception as ei:
-                log("Very unexpected error while running scheduled job.")
-    time.sleep(1)
+            loop.add_signal_handler(signal_number, stop_event.set)
+        except (NotImplementedError, RuntimeError, ValueError):
+            # Not supported on this platform or outside of the main thread
+            pass
+
+    log("Starting tasks...")
+    tasks = [asyncio.create_task(process_queue(queue_ready))]
+    tasks += [asyncio.create_task(poll_feed(feed)) for feed in feeds]
+    if LAG_CHECK_INTERVAL:
+        tasks.append(asyncio.create_task(run_periodically(LAG_CHECK_INTERVAL, check_lag)))
+    if METRICS_SUMMARY_INTERVAL:
+        tasks.append(asyncio.create_task(run_periodically(METRICS_SUMMARY_INTERVAL, log_metrics_summary)))
+    log("Started.")
+
+    try:
+        await loop.run_in_executor(None, stop_event.wait)
+    finally:
+        log("Stopping...")
+        stop_event.set()
+        entry_queue.close()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Let the threads finish the poll and the entry in progress
+        await loop.run_in_executor(None, poll_executor.shutdown)
+        await loop.run_in_executor(None, send_executor.shutdown)
+        # The queued downloads and backfills are not needed anymore, they use the processed store
+        await loop.run_in_executor(None, lambda: prefetch_executor.shutdown(cancel_futures=True))
+        await loop.run_in_executor(None, lambda: backfill_executor.shutdown(cancel_futures=True))
+        if shards:
+            await loop.run_in_executor(None, stop_shards)
+        entry_queue.listener = None
+        processed_store.close()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        if response_recorder is not None:
+            response_recorder.close()
+        log("Stopped.")
+
+def run():
+    asyncio.run(run_async())
+
+def main():
+    setup()
+    run()
+
 
+if __name__ == '__main__':
+    main()